@@ -0,0 +1,56 @@
+'Common base for api request handlers'
+from webob import exc
+
+# pylint: disable=F0401
+from api import etags
+from api import instrument
+from pulldb.base import OauthHandler
+from pulldb.models import users
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+USER_KEY_CACHE = 'pulldb.user_keys'
+
+class ApiHandler(OauthHandler):
+    def dispatch(self):
+        instrument.start()
+        status = None
+        try:
+            return super(ApiHandler, self).dispatch()
+        except exc.HTTPException as error:
+            # abort() is only turned into a response further up
+            status = error.code
+            raise
+        except Exception:
+            status = 500
+            raise
+        finally:
+            route = getattr(self.request.route, 'template',
+                            self.__class__.__name__)
+            instrument.finish(route, status or self.response.status_int,
+                              len(self.response.body))
+
+    def not_modified(self, *versions):
+        '''Set a strong ETag built from version stamps for this request.
+
+        Returns True, after setting a 304 status, when the client already
+        holds the current representation.
+        '''
+        etag = etags.make_etag(self.request.path_qs, *versions)
+        self.response.etag = etag
+        if etag in self.request.if_none_match:
+            self.response.status_int = 304
+            return True
+        return False
+
+    def lookup_user_key(self, create=True):
+        '''users.user_key() for the current user, memoised per request.
+
+        Requests dispatched by /api/batch share the same cache, so the
+        lookup only happens once per batch.
+        '''
+        cache = self.request.environ.setdefault(USER_KEY_CACHE, {})
+        cache_key = (self.user, create)
+        if cache_key not in cache:
+            cache[cache_key] = users.user_key(self.user, create=create)
+        return cache[cache_key]
@@ -0,0 +1,114 @@
+'API endpoint for running several api calls in one request'
+import json
+import logging
+import threading
+
+import webapp2
+
+# pylint: disable=F0401
+from api import issues
+from api import pulls
+from api import streams
+from api import subscriptions
+from api import volumes
+from api.base import ApiHandler, USER_KEY_CACHE
+from pulldb.base import create_app, Route
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+MAX_REQUESTS = 20
+
+APPS = (
+    ('/api/issues/', issues.app),
+    ('/api/pulls/', pulls.app),
+    ('/api/streams/', streams.app),
+    ('/api/subscriptions/', subscriptions.app),
+    ('/api/volumes/', volumes.app),
+)
+
+def find_app(path):
+    for prefix, app in APPS:
+        if path.startswith(prefix):
+            return app
+
+class Batch(ApiHandler):
+    def sub_request(self, spec):
+        method = spec.get('method', 'GET').upper()
+        request = webapp2.Request.blank(spec['path'], environ={
+            'REQUEST_METHOD': method,
+            USER_KEY_CACHE: self.request.environ.setdefault(
+                USER_KEY_CACHE, {}),
+        })
+        for header in ('Authorization', 'User-Agent'):
+            if header in self.request.headers:
+                request.headers[header] = self.request.headers[header]
+        body = spec.get('body')
+        if body is not None:
+            if not isinstance(body, basestring):
+                body = json.dumps(body)
+            request.body = body.encode('utf-8')
+        return request
+
+    def dispatch_one(self, spec, results, index):
+        path = spec.get('path', '')
+        app = find_app(path)
+        if not app:
+            results[index] = {
+                'path': path,
+                'status': 404,
+                'body': 'No api route for %r' % path,
+            }
+            return
+        try:
+            response = self.sub_request(spec).get_response(app)
+        except Exception as error: # pylint: disable=W0703
+            logging.exception(error)
+            results[index] = {
+                'path': path,
+                'status': 500,
+                'body': 'Error dispatching %r' % path,
+            }
+            return
+        try:
+            body = json.loads(response.body)
+        except ValueError:
+            body = response.body
+        results[index] = {
+            'path': path,
+            'status': response.status_int,
+            'body': body,
+        }
+
+    def post(self):
+        request = json.loads(self.request.body)
+        specs = request.get('requests', [])
+        if len(specs) > MAX_REQUESTS:
+            self.response.write(json.dumps({
+                'status': 400,
+                'message': 'Too many requests (%d > %d)' % (
+                    len(specs), MAX_REQUESTS),
+            }))
+            return
+        # Populate the shared user key cache before fanning out
+        self.lookup_user_key()
+        results = [None] * len(specs)
+        # Each sub-request runs in its own thread, and so its own ndb
+        # context, so their datastore work overlaps.
+        threads = [
+            threading.Thread(
+                target=self.dispatch_one, args=(spec, results, index))
+            for index, spec in enumerate(specs)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.response.write(json.dumps({
+            'status': 200,
+            'message': 'Dispatched %d requests' % len(specs),
+            'results': results,
+        }))
+
+app = create_app([
+    Route('/api/batch', Batch),
+])
@@ -0,0 +1,95 @@
+'Change log used for incremental pull sync'
+import base64
+from datetime import datetime, timedelta
+import logging
+
+from google.appengine.ext import ndb
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+EPOCH = datetime(1970, 1, 1)
+# Changes this recent may still be committing on other instances, so
+# watermarks never advance past them.
+SETTLE_TIME = timedelta(seconds=5)
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+class InvalidWatermark(ValueError):
+    pass
+
+class PullChange(ndb.Model):
+    updated = ndb.DateTimeProperty(auto_now=True)
+    deleted = ndb.BooleanProperty(default=False, indexed=False)
+
+def change_key(pull_key):
+    return ndb.Key(PullChange, pull_key.id(), parent=pull_key.parent())
+
+def record_changes(pull_list, deleted=()):
+    '''Return the change log entities for modified and removed pulls.'''
+    return [
+        PullChange(key=change_key(pull.key)) for pull in pull_list
+    ] + [
+        PullChange(key=change_key(pull.key), deleted=True)
+        for pull in deleted
+    ]
+
+def encode_watermark(timestamp, last_id=0):
+    delta = timestamp - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return base64.urlsafe_b64encode('%d:%d' % (micros, last_id))
+
+def decode_watermark(token):
+    try:
+        micros, last_id = base64.urlsafe_b64decode(str(token)).split(':')
+        return EPOCH + timedelta(microseconds=int(micros)), int(last_id)
+    except (TypeError, ValueError):
+        raise InvalidWatermark('Invalid watermark %r' % token)
+
+def current_watermark():
+    return encode_watermark(datetime.utcnow() - SETTLE_TIME)
+
+@ndb.tasklet
+def changes_since_async(user_key, token, limit=500):
+    '''Return (changes, watermark, more) for changes after token.'''
+    since, last_id = decode_watermark(token)
+    if since < datetime.utcnow() - TOMBSTONE_RETENTION:
+        raise InvalidWatermark('Watermark %r has expired' % token)
+    after = PullChange.query(
+        PullChange.updated > since,
+        ancestor=user_key,
+    ).order(PullChange.updated, PullChange.key).fetch_async(limit + 1)
+    tied = []
+    if last_id:
+        # Changes written in the same microsecond as the watermark
+        tied = yield PullChange.query(
+            PullChange.updated == since,
+            PullChange.key > ndb.Key(PullChange, last_id, parent=user_key),
+            ancestor=user_key,
+        ).order(PullChange.key).fetch_async(limit + 1)
+    entries = tied + (yield after)
+    more = len(entries) > limit
+    entries = entries[:limit]
+    settled = datetime.utcnow() - SETTLE_TIME
+    if not more:
+        # Hold the watermark back so late commits are picked up next time
+        settled_entries = [
+            entry for entry in entries if entry.updated < settled]
+    else:
+        settled_entries = entries
+    if settled_entries:
+        last = settled_entries[-1]
+        watermark = encode_watermark(last.updated, last.key.id())
+    elif since <= settled:
+        watermark = encode_watermark(since, last_id)
+    else:
+        watermark = encode_watermark(settled)
+    raise ndb.Return(entries, watermark, more)
+
+def purge_changes(user_key):
+    cutoff = datetime.utcnow() - TOMBSTONE_RETENTION
+    query = PullChange.query(
+        PullChange.updated < cutoff,
+        ancestor=user_key,
+    )
+    keys = query.fetch(keys_only=True)
+    ndb.delete_multi(keys)
+    logging.info('Purged %d change records for %r', len(keys), user_key)
@@ -0,0 +1,95 @@
+'Materialized per-user pull counters'
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from pulldb.models import pulls
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+STATES = ('new', 'unread', 'read', 'total')
+
+class PullCounter(ndb.Model):
+    new = ndb.IntegerProperty(default=0, indexed=False)
+    unread = ndb.IntegerProperty(default=0, indexed=False)
+    read = ndb.IntegerProperty(default=0, indexed=False)
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def counts(self):
+        return {name: getattr(self, name) for name in STATES}
+
+def counter_key(user_key):
+    return ndb.Key(PullCounter, 'pulls', parent=user_key)
+
+def pull_state(pull):
+    if not pull:
+        return {}
+    return {
+        'new': int(not pull.pulled),
+        'unread': int(bool(pull.pulled and not pull.read)),
+        'read': int(bool(pull.read)),
+        'total': 1,
+        'stream': pull.stream,
+    }
+
+def tally(changes):
+    '''Sum the counter changes for a sequence of (before, after) states.'''
+    delta = dict.fromkeys(STATES, 0)
+    for before, after in changes:
+        for name in STATES:
+            delta[name] += after.get(name, 0) - before.get(name, 0)
+    return delta
+
+@ndb.transactional_tasklet
+def apply_delta_async(user_key, delta):
+    counter = yield counter_key(user_key).get_async()
+    if not counter:
+        # Nothing to adjust yet, the first stats request will reconcile
+        raise ndb.Return(None)
+    for name in STATES:
+        setattr(counter, name, max(getattr(counter, name) + delta[name], 0))
+    yield counter.put_async()
+    raise ndb.Return(counter)
+
+def apply_delta(user_key, delta):
+    if any(delta.values()):
+        return apply_delta_async(user_key, delta).get_result()
+
+def reconcile(user_key):
+    total_count = pulls.Pull.query(
+        ancestor=user_key).count_async()
+    new_count = pulls.Pull.query(
+        pulls.Pull.pulled == False,
+        ancestor=user_key).count_async()
+    unread_count = pulls.Pull.query(
+        pulls.Pull.pulled == True,
+        pulls.Pull.read == False,
+        ancestor=user_key).count_async()
+    read_count = pulls.Pull.query(
+        pulls.Pull.read == True,
+        ancestor=user_key).count_async()
+    counter = PullCounter(
+        key=counter_key(user_key),
+        new=new_count.get_result(),
+        unread=unread_count.get_result(),
+        read=read_count.get_result(),
+        total=total_count.get_result(),
+    )
+    counter.put()
+    logging.info('Reconciled pull counts for %r: %r',
+                 user_key, counter.counts())
+    return counter
+
+def reconcile_all(position=None, batch_size=100):
+    query = PullCounter.query()
+    counter_keys, next_cursor, more = query.fetch_page(
+        batch_size, start_cursor=Cursor(urlsafe=position), keys_only=True)
+    for key in counter_keys:
+        deferred.defer(reconcile, key.parent())
+    if more and next_cursor:
+        deferred.defer(reconcile_all, position=next_cursor.urlsafe(),
+                       batch_size=batch_size)
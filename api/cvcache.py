@@ -0,0 +1,214 @@
+'Caching layer for the ComicVine calls made by the api handlers'
+from collections import defaultdict
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+# pylint: disable=F0401
+from api import instrument
+from api import lru
+from pulldb.models import comicvine
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+# (fresh, stale) lifetimes in seconds.  Stale entries are still served
+# but trigger a background refresh.
+TTLS = {
+    'fetch_volume_batch': (6 * 3600, 7 * 86400),
+    'search_volume': (900, 6 * 3600),
+    'fetch_issue': (600, 86400),
+}
+REFRESH_LOCK_TTL = 60
+
+# Search results and volume batches run to tens of kilobytes each, so
+# the local cache is bounded by size as well as by count.
+local_cache = lru.LRUCache(maxsize=500, maxbytes=2 * 1024 * 1024)
+
+_stats = defaultdict(lambda: defaultdict(int))
+_stats_lock = threading.Lock()
+
+def record(call_type, event, count=1):
+    with _stats_lock:
+        _stats[call_type][event] += count
+
+def stats():
+    with _stats_lock:
+        return {
+            call_type: dict(events) for call_type, events in _stats.items()
+        }
+
+def cache_key(call_type, *args):
+    digest = hashlib.md5(repr(args)).hexdigest()
+    return 'cv:%s:%s' % (call_type, digest)
+
+def store(call_type, key, value):
+    fresh, stale = TTLS[call_type]
+    entry = {'value': value, 'fresh_until': time.time() + fresh}
+    local_cache.set(key, entry, ttl=stale)
+    memcache.set(key, entry, time=stale)
+
+def lookup_multi(call_type, keys):
+    '''Return a dict of key to cache entry for the keys found.'''
+    entries = {}
+    remote = []
+    for key in keys:
+        entry = local_cache.get(key)
+        if entry:
+            entries[key] = entry
+        else:
+            remote.append(key)
+    record(call_type, 'local_hit', len(keys) - len(remote))
+    if remote:
+        found = memcache.get_multi(remote)
+        for key, entry in found.items():
+            local_cache.set(key, entry, ttl=TTLS[call_type][1])
+            entries[key] = entry
+        record(call_type, 'memcache_hit', len(found))
+        record(call_type, 'miss', len(remote) - len(found))
+    return entries
+
+def refresh(call_type, args):
+    '''Re-run an upstream call and store the result in the cache.'''
+    CachedComicvine().upstream(call_type, args)
+
+def schedule_refresh(call_type, key, args):
+    if memcache.add('%s:refresh' % key, 1, time=REFRESH_LOCK_TTL):
+        record(call_type, 'refresh')
+        deferred.defer(refresh, call_type, args)
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    '''Coalesce concurrent calls that share a key.
+
+    The first caller runs the function, any caller arriving while it is
+    still running waits for and shares its result.
+    '''
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function(*args)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+inflight = SingleFlight()
+
+class CachedComicvine(object):
+    '''Wraps the comicvine client with a two tier response cache.
+
+    Lookups check an instance-local LRU first and memcache second.  The
+    upstream client is only loaded when a call actually misses.
+    '''
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        if not self._client:
+            self._client = comicvine.load()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def call_upstream(self, call_type, args):
+        record(call_type, 'upstream')
+        instrument.count('comicvine')
+        if call_type == 'fetch_volume_batch':
+            results = self.client.fetch_volume_batch(*args)
+            for result in results:
+                store(call_type, cache_key(call_type, int(result['id'])),
+                      result)
+            return results
+        if call_type == 'search_volume':
+            query, page, limit = args
+            value = self.client.search_volume(query, page=page, limit=limit)
+        else:
+            value = getattr(self.client, call_type)(*args)
+        store(call_type, cache_key(call_type, *args), value)
+        return value
+
+    def upstream(self, call_type, args):
+        '''Call ComicVine and cache the result, coalescing duplicates.'''
+        value, coalesced = inflight.do(
+            cache_key(call_type, *args), self.call_upstream, call_type, args)
+        if coalesced:
+            record(call_type, 'coalesced')
+        return value
+
+    def cached_call(self, call_type, *args):
+        key = cache_key(call_type, *args)
+        entry = lookup_multi(call_type, [key]).get(key)
+        if entry:
+            if entry['fresh_until'] < time.time():
+                record(call_type, 'stale_hit')
+                schedule_refresh(call_type, key, args)
+            return entry['value']
+        return self.upstream(call_type, args)
+
+    def fetch_volume_batch(self, volume_ids):
+        keys = [
+            cache_key('fetch_volume_batch', int(volume_id))
+            for volume_id in volume_ids
+        ]
+        entries = lookup_multi('fetch_volume_batch', keys)
+        found = {}
+        missing = []
+        stale = []
+        for volume_id, key in zip(volume_ids, keys):
+            entry = entries.get(key)
+            if not entry:
+                missing.append(volume_id)
+                continue
+            found[int(volume_id)] = entry['value']
+            if entry['fresh_until'] < time.time():
+                stale.append(volume_id)
+        if stale:
+            record('fetch_volume_batch', 'stale_hit', len(stale))
+            schedule_refresh(
+                'fetch_volume_batch',
+                cache_key('fetch_volume_batch', *stale), (stale,))
+        if missing:
+            logging.debug('Fetching %d uncached volumes', len(missing))
+            for result in self.upstream('fetch_volume_batch', (missing,)):
+                found[int(result['id'])] = result
+        return [
+            found[int(volume_id)] for volume_id in volume_ids
+            if int(volume_id) in found
+        ]
+
+    def search_volume(self, query, page=0, limit=20):
+        return self.cached_call('search_volume', query, page, limit)
+
+    def fetch_issue(self, identifier):
+        return self.cached_call('fetch_issue', int(identifier))
+
+def load():
+    return CachedComicvine()
@@ -0,0 +1,64 @@
+'Version stamps used to build ETags for read endpoints'
+import hashlib
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# pylint: disable=W0232,E1101,R0903,C0103,W0212
+
+def entity_version(entity):
+    '''Return a cheap version stamp for an entity.
+
+    Uses the entity's auto_now timestamp where the model has one, and a
+    checksum of the stored protocol buffer otherwise.
+    '''
+    if entity is None:
+        return '-'
+    prop = auto_now_property(entity)
+    if prop is not None:
+        value = prop._get_value(entity)
+        if value:
+            return '%s@%s' % (entity.key.urlsafe(), value.isoformat())
+    checksum = zlib.crc32(entity._to_pb().Encode()) & 0xffffffff
+    return '%s#%08x' % (entity.key.urlsafe(), checksum)
+
+def make_etag(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts)).hexdigest()
+
+def auto_now_property(model):
+    for prop in model._properties.values():
+        if isinstance(prop, ndb.DateTimeProperty) and prop._auto_now:
+            return prop
+
+def update_time(entity):
+    '''Return the auto_now timestamp of an entity, or None.'''
+    prop = auto_now_property(entity)
+    if prop is not None:
+        value = prop._get_value(entity)
+        if value:
+            return value.isoformat()
+
+def version_key(scope):
+    return 'etagver:%s' % scope.urlsafe()
+
+def collection_version(scope):
+    '''Return the change counter for the entities under scope.
+
+    The counter lives in memcache and is seeded from the clock, so a
+    counter lost to eviction restarts above any value already handed out
+    in an ETag.
+    '''
+    key = version_key(scope)
+    version = memcache.get(key)
+    if version is None:
+        memcache.add(key, int(time.time() * 1000))
+        version = memcache.get(key)
+    return version
+
+def touch(scopes):
+    '''Advance the change counters for scopes whose entities changed.'''
+    for scope in scopes:
+        memcache.incr(version_key(scope),
+                      initial_value=int(time.time() * 1000))
@@ -0,0 +1,131 @@
+'API endpoint for bulk export of a user collection as NDJSON'
+import base64
+from functools import partial
+import json
+import logging
+import zlib
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+# pylint: disable=F0401
+from api.base import ApiHandler
+from api.pulls import pull_context
+from api.streams import streams_context
+from api.subscriptions import subscription_context
+from pulldb.base import create_app, Route
+from pulldb.models import pulls
+from pulldb.models import streams
+from pulldb.models import subscriptions
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+KINDS = ('pulls', 'subscriptions', 'streams')
+BATCH_SIZE = 100
+MAX_RECORDS = 5000
+
+def encode_position(kind, cursor=''):
+    return base64.urlsafe_b64encode(json.dumps([kind, cursor]))
+
+def decode_position(token):
+    try:
+        kind, cursor = json.loads(base64.urlsafe_b64decode(str(token)))
+        if kind not in KINDS:
+            raise ValueError('Unknown kind %r' % kind)
+        return kind, Cursor(urlsafe=cursor) if cursor else None
+    except (TypeError, ValueError, datastore_errors.BadValueError):
+        raise ValueError('Invalid position %r' % token)
+
+class Export(ApiHandler):
+    queries = {
+        'pulls': (pulls.Pull, pull_context),
+        'subscriptions': (subscriptions.Subscription, subscription_context),
+        # exports carry complete member lists
+        'streams': (streams.Stream, partial(streams_context, limit=None)),
+    }
+
+    def emit(self, record):
+        line = json.dumps(record) + '\n'
+        if self.compressor:
+            line = self.compressor.compress(line)
+        if line:
+            self.response.write(line)
+
+    def export_kind(self, kind, user_key, cursor, budget):
+        '''Write records for one kind.
+
+        Returns the number of records written and whether the kind was
+        exhausted.  A resume position is emitted after every batch.
+        '''
+        model, context_callback = self.queries[kind]
+        query = model.query(ancestor=user_key)
+        context = self.request.get('context')
+        written = 0
+        page = query.fetch_page_async(BATCH_SIZE, start_cursor=cursor)
+        while True:
+            entities, next_cursor, more = page.get_result()
+            if more and next_cursor:
+                # fetch the next batch while this one is resolved
+                page = query.fetch_page_async(
+                    BATCH_SIZE, start_cursor=next_cursor)
+            records = context_callback(entities, context).get_result()
+            for record in records:
+                record['type'] = kind
+                self.emit(record)
+            written += len(records)
+            if not (more and next_cursor):
+                return written, True
+            position = encode_position(kind, next_cursor.urlsafe())
+            self.emit({'type': 'position', 'position': position})
+            if written >= budget:
+                return written, False
+
+    def get(self):
+        user_key = self.lookup_user_key()
+        requested = self.request.get('kinds', ','.join(KINDS)).split(',')
+        kinds = [kind for kind in KINDS if kind in requested]
+        cursor = None
+        if self.request.get('position'):
+            try:
+                start_kind, cursor = decode_position(
+                    self.request.get('position'))
+            except ValueError as error:
+                logging.info('Rejecting export request: %s', error)
+                self.abort(400)
+            if start_kind not in kinds:
+                self.abort(400)
+            kinds = kinds[kinds.index(start_kind):]
+        self.compressor = None
+        self.response.content_type = 'application/x-ndjson'
+        if self.request.get('gzip'):
+            # served as a gzip file rather than with Content-Encoding,
+            # which the frontend manages itself
+            self.compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            self.response.content_type = 'application/gzip'
+            self.response.headers['Content-Disposition'] = (
+                'attachment; filename="export.ndjson.gz"')
+        remaining = MAX_RECORDS
+        complete = True
+        for index, kind in enumerate(kinds):
+            written, finished = self.export_kind(
+                kind, user_key, cursor, remaining)
+            remaining -= written
+            cursor = None
+            if not finished:
+                complete = False
+                break
+            if index + 1 < len(kinds):
+                self.emit({
+                    'type': 'position',
+                    'position': encode_position(kinds[index + 1]),
+                })
+                if remaining <= 0:
+                    complete = False
+                    break
+        self.emit({'type': 'end', 'complete': complete})
+        if self.compressor:
+            self.response.write(self.compressor.flush())
+
+app = create_app([
+    Route('/api/export', Export),
+])
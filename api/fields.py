@@ -0,0 +1,51 @@
+'Helpers for the fields= response selection parameter'
+import logging
+
+# pylint: disable=W0232,E1101,R0903,C0103,W0212
+
+# (kind, projection) pairs the datastore had no index for on this instance
+unindexed = set()
+
+def requested(request):
+    '''Return the set of field names asked for, or None for all.'''
+    fields = request.get('fields')
+    if not fields:
+        return None
+    return set(name.strip() for name in fields.split(',') if name.strip())
+
+def select(data, fields):
+    if fields is None or not data:
+        return data
+    return {name: value for name, value in data.items() if name in fields}
+
+def trim(result, fields):
+    '''Apply select to each entity dict in a context result.'''
+    if fields is None:
+        return result
+    return {name: select(value, fields) for name, value in result.items()}
+
+def projection(model, fields, order=()):
+    '''Return a projection for a query on model, or None if unsuitable.
+
+    Projection is only used when every requested field is an indexed,
+    non-repeated property.  Properties the query sorts on are included
+    as the datastore requires.  Most projections need a composite index,
+    so callers fall back to a full fetch when it is missing, and the
+    projection is not tried again.
+    '''
+    if not fields:
+        return None
+    names = set(fields).union(order)
+    for name in names:
+        prop = model._properties.get(name)
+        if prop is None or not prop._indexed or prop._repeated:
+            return None
+    names = tuple(sorted(names))
+    if (model._get_kind(), names) in unindexed:
+        return None
+    return names
+
+def missing_index(kind, projection):
+    logging.warn('No index for projection %r on %s, fetching entities',
+                 projection, kind)
+    unindexed.add((kind, tuple(projection)))
@@ -0,0 +1,198 @@
+'API endpoints for bulk import of pulls and subscriptions'
+from collections import defaultdict
+import json
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from api import changes
+from api import counters
+from api import paging
+from api import unread
+from api.base import ApiHandler
+from api.pulls import plan_pulls, write_pulls
+from api.subscriptions import plan_subscriptions_async
+from pulldb.base import create_app, Route
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+CHUNK_SIZE = 200
+MAX_ITEMS = 10000
+
+def plan_subscriptions(user_key, volume_ids):
+    return plan_subscriptions_async(user_key, volume_ids).get_result()
+
+def write_new_pulls(user_key, new_pulls):
+    write_pulls(user_key, updated=[({}, pull) for pull in new_pulls])
+
+def recover_pulls(user_key, new_pulls):
+    '''Finish a pull write that may have been interrupted part way.
+
+    Only pulls that are still missing are written, so changes the user
+    made since the first attempt are kept.  The derived counts are
+    rebuilt rather than adjusted since there is no telling which of them
+    were already applied.
+    '''
+    existing = ndb.get_multi([pull.key for pull in new_pulls])
+    missing = [
+        pull for pull, current in zip(new_pulls, existing) if not current]
+    ndb.put_multi(missing + changes.record_changes(missing))
+    counters.reconcile(user_key)
+    unread.rebuild(user_key)
+    paging.invalidate(user_key)
+
+def write_subscriptions(user_key, subs):
+    ndb.put_multi(subs)
+    paging.invalidate(user_key)
+
+# (request field, plan, write, recover) where plan returns the per-item
+# results and the entities to write, and recover must be safe to repeat.
+IMPORTERS = {
+    'pulls': ('issues', plan_pulls, write_new_pulls, recover_pulls),
+    'subscriptions': ('volumes', plan_subscriptions, write_subscriptions,
+                      write_subscriptions),
+}
+
+class ImportJob(ndb.Model):
+    kind = ndb.StringProperty(indexed=False)
+    total = ndb.IntegerProperty(indexed=False)
+    chunks = ndb.IntegerProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class ImportChunk(ndb.Model):
+    '''One task queue job's worth of an import, keyed by its position.
+
+    The results and the entities to write are saved before any writes
+    are made, so a retried task can finish the chunk and still report
+    what it did.
+    '''
+    items = ndb.JsonProperty()
+    results = ndb.JsonProperty()
+    pending = ndb.PickleProperty(compressed=True)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+def chunk_key(job_key, index):
+    return ndb.Key(ImportChunk, index, parent=job_key)
+
+def defer_chunk(job_key, index):
+    '''Queue a chunk, at most once however often the caller retries.'''
+    try:
+        deferred.defer(process_chunk, chunk_key(job_key, index),
+                       _name='import-%s-%d' % (job_key.urlsafe(), index))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        logging.info('Import chunk %d of %r already queued', index, job_key)
+
+def start_import(user_key, kind, items):
+    job_key = ImportJob(
+        parent=user_key,
+        kind=kind,
+        total=len(items),
+        chunks=(len(items) + CHUNK_SIZE - 1) // CHUNK_SIZE,
+    ).put()
+    ndb.put_multi([
+        ImportChunk(
+            key=chunk_key(job_key, index // CHUNK_SIZE + 1),
+            items=items[index:index + CHUNK_SIZE],
+        ) for index in range(0, len(items), CHUNK_SIZE)
+    ])
+    # Chunks write to the same user entity group, so they run one at a
+    # time with each chunk queueing the next.
+    defer_chunk(job_key, 1)
+    return job_key
+
+def process_chunk(key):
+    chunk = key.get()
+    if not chunk:
+        return
+    job = key.parent().get()
+    user_key = job.key.parent()
+    _, plan, write, recover = IMPORTERS[job.kind]
+    if not chunk.done:
+        if chunk.results is None:
+            chunk.results, chunk.pending = plan(user_key, chunk.items)
+            chunk.put()
+            write(user_key, chunk.pending)
+        else:
+            logging.warn('Recovering interrupted import chunk %r', key)
+            recover(user_key, chunk.pending)
+        chunk.pending = None
+        chunk.done = True
+        chunk.put()
+        logging.info('Import %s chunk %d done: %r', job.key.id(),
+                     key.id(), dict(
+                         (status, len(ids))
+                         for status, ids in chunk.results.items()))
+    if key.id() < job.chunks:
+        defer_chunk(job.key, key.id() + 1)
+
+def job_status(job):
+    results = defaultdict(list)
+    completed = 0
+    processed = 0
+    for chunk in ImportChunk.query(ancestor=job.key):
+        if chunk.done:
+            completed += 1
+            processed += len(chunk.items)
+            for status, ids in chunk.results.items():
+                results[status].extend(ids)
+    return {
+        'id': job.key.id(),
+        'kind': job.kind,
+        'created': job.created.isoformat(),
+        'total': job.total,
+        'processed': processed,
+        'chunks': job.chunks,
+        'completed_chunks': completed,
+        'complete': completed == job.chunks,
+    }, results
+
+class StartImport(ApiHandler):
+    def post(self, kind):
+        if kind not in IMPORTERS:
+            self.abort(404)
+        user_key = self.lookup_user_key()
+        request = json.loads(self.request.body)
+        items = request.get(IMPORTERS[kind][0], [])
+        if not items or len(items) > MAX_ITEMS:
+            logging.info('Rejecting import of %d %s', len(items), kind)
+            self.abort(400)
+        try:
+            items = [int(item) for item in items]
+        except (TypeError, ValueError):
+            logging.info('Rejecting import of %s with invalid ids', kind)
+            self.abort(400)
+        job_key = start_import(user_key, kind, items)
+        response = {
+            'status': 202,
+            'message': 'Importing %d %s' % (len(items), kind),
+            'job': job_key.id(),
+        }
+        self.response.status_int = 202
+        self.response.write(json.dumps(response))
+
+class ImportStatus(ApiHandler):
+    def get(self, identifier):
+        user_key = self.lookup_user_key()
+        job = None
+        if identifier.isdigit():
+            job = ndb.Key(
+                ImportJob, int(identifier), parent=user_key).get()
+        if not job:
+            self.abort(404)
+        job_dict, results = job_status(job)
+        response = {
+            'status': 200,
+            'job': job_dict,
+            'results': results,
+        }
+        self.response.write(json.dumps(response))
+
+app = create_app([
+    Route('/api/import/<kind>', StartImport),
+    Route('/api/import/<identifier>/status', ImportStatus),
+])
@@ -0,0 +1,130 @@
+'Lightweight per-route request and RPC instrumentation'
+from collections import defaultdict
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+FLUSH_INTERVAL = 60
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+ROUTE_INDEX = 'stats:routes'
+STATUS_CODES = (200, 202, 304, 400, 401, 404, 410, 500)
+STATS_PREFIX = 'stats:'
+
+DATASTORE_CALLS = {
+    'Get': 'get',
+    'Put': 'put',
+    'Delete': 'delete',
+    'RunQuery': 'query',
+    'Next': 'query',
+}
+
+_local = threading.local()
+_pending = defaultdict(lambda: defaultdict(int))
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+def latency_bucket(latency_ms):
+    for bucket in LATENCY_BUCKETS:
+        if latency_ms <= bucket:
+            return 'latency.le_%d' % bucket
+    return 'latency.gt_%d' % LATENCY_BUCKETS[-1]
+
+def count(name, value=1):
+    '''Add to a counter for the request running on this thread.'''
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] += value
+
+def datastore_hook(service, call, request, response):
+    call_type = DATASTORE_CALLS.get(call)
+    if not call_type:
+        return
+    if call == 'RunQuery' and request.has_limit() and request.limit() == 0:
+        # ndb runs counts as zero limit queries that skip ahead by offset
+        call_type = 'count'
+    count('rpc.%s' % call_type)
+
+def start():
+    _local.counters = defaultdict(int)
+    _local.started = time.time()
+
+def finish(route, status, response_size):
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        return
+    latency_ms = int((time.time() - _local.started) * 1000)
+    _local.counters = None
+    counters['requests'] += 1
+    counters['latency_ms'] += latency_ms
+    counters[latency_bucket(latency_ms)] += 1
+    counters['bytes'] += response_size
+    counters['status.%d' % status] += 1
+    with _lock:
+        for name, value in counters.items():
+            _pending[route][name] += value
+        flush_due = time.time() - _last_flush[0] > FLUSH_INTERVAL
+        if flush_due:
+            _last_flush[0] = time.time()
+    if flush_due:
+        flush()
+
+def drain():
+    '''Return and reset the counters gathered since the last flush.'''
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    return pending
+
+def flush():
+    '''Merge this instance's counters into the shared memcache totals.'''
+    pending = drain()
+    if not pending:
+        return
+    offsets = {}
+    for route, counters in pending.items():
+        for name, value in counters.items():
+            offsets['%s|%s' % (route, name)] = value
+    memcache.offset_multi(offsets, key_prefix=STATS_PREFIX, initial_value=0)
+    routes = set(memcache.get(ROUTE_INDEX) or [])
+    if not routes.issuperset(pending):
+        memcache.set(ROUTE_INDEX, sorted(routes.union(pending)))
+    logging.debug('Flushed request stats for %d routes', len(pending))
+
+def report():
+    routes = memcache.get(ROUTE_INDEX) or []
+    names = [
+        'requests', 'latency_ms', 'bytes', 'comicvine',
+    ] + [
+        'rpc.%s' % call_type
+        for call_type in sorted(set(DATASTORE_CALLS.values())) + ['count']
+    ] + [
+        latency_bucket(bucket) for bucket in LATENCY_BUCKETS
+    ] + [
+        latency_bucket(LATENCY_BUCKETS[-1] + 1)
+    ] + [
+        'status.%d' % status for status in STATUS_CODES
+    ]
+    keys = [
+        '%s|%s' % (route, name) for route in routes for name in names
+    ]
+    values = memcache.get_multi(keys, key_prefix=STATS_PREFIX)
+    results = {}
+    for route in routes:
+        stats = {}
+        for name in names:
+            value = values.get('%s|%s' % (route, name))
+            if value:
+                stats[name] = value
+        if stats.get('requests'):
+            stats['mean_latency_ms'] = (
+                stats.get('latency_ms', 0) / stats['requests'])
+        results[route] = stats
+    return results
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'api_instrument', datastore_hook, 'datastore_v3')
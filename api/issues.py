@@ -3,23 +3,26 @@ import json
 import logging
 
 from google.appengine.api import search
-from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 # pylint: disable=F0401
-from pulldb.base import create_app, Route, OauthHandler
+from api import cvcache
+from api import etags
+from api import fields
+from api import loader
+from api import paging
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
 from pulldb.models.base import model_to_dict
-from pulldb.models import comicvine
 from pulldb.models import issues
 from pulldb.models import pulls
-from pulldb.models import users
 from pulldb.models import volumes
 
 # pylint: disable=W0232,E1101,R0903,C0103
 
-class DropIndex(OauthHandler):
+class DropIndex(ApiHandler):
     def get(self, doc_id):
-        user = users.user_key(app_user=self.user).get()
+        user = self.lookup_user_key().get()
         if not user.trusted:
             logging.warn('Untrusted access attempt: %r', self.user)
             self.abort(401)
@@ -40,12 +43,12 @@ class DropIndex(OauthHandler):
             }
         self.response.write(json.dumps(response))
 
-class GetIssue(OauthHandler):
+class GetIssue(ApiHandler):
     @ndb.tasklet
     def issue_context(self, issue):
         volume_dict = {}
         if self.request.get('context'):
-            volume = yield issue.volume.get_async()
+            volume = yield loader.get_async(issue.volume)
             volume_dict = model_to_dict(volume)
         raise ndb.Return({
             'volume': volume_dict,
@@ -54,13 +57,28 @@ class GetIssue(OauthHandler):
 
     def get(self, identifier):
         query = issues.Issue.query(issues.Issue.identifier == int(identifier))
-        results = query.map(self.issue_context)
+        issue_list = query.fetch()
+        versions = [etags.entity_version(issue) for issue in issue_list]
+        if self.request.get('context'):
+            volume_map = loader.fetch_map_async(
+                [issue.volume for issue in issue_list]).get_result()
+            versions.extend(
+                etags.entity_version(volume)
+                for key, volume in sorted(volume_map.items()))
+        if self.not_modified(*versions):
+            return
+        selected = fields.requested(self.request)
+        context_futures = [self.issue_context(issue) for issue in issue_list]
+        results = [
+            fields.trim(future.get_result(), selected)
+            for future in context_futures
+        ]
         self.response.write(json.dumps({
             'status': 200,
             'results': results
         }))
 
-class ListIssues(OauthHandler):
+class ListIssues(ApiHandler):
     order_keys = {
         ('pubdate', 'asc'): issues.Issue.pubdate,
         ('pubdate', 'desc'): -issues.Issue.pubdate,
@@ -74,7 +92,7 @@ class ListIssues(OauthHandler):
             pull_key = ndb.Key('Pull', issue.key.id(), parent=self.user_key)
             pull, volume = yield (
                 pull_key.get_async(),
-                issue.volume.get_async()
+                loader.get_async(issue.volume)
             )
             pull_dict = model_to_dict(pull)
             volume_dict = model_to_dict(volume)
@@ -85,51 +103,60 @@ class ListIssues(OauthHandler):
         })
 
     @ndb.tasklet
-    def fetch_page(self, query):
-        limit = self.request.get('limit', 10)
-        cursor = Cursor(urlsafe=self.request.get('position'))
-        issue_matches, next_cursor, more = yield query.fetch_page_async(
-            limit, start_cursor=cursor)
+    def page_context(self, issue_matches):
         context_futures = [self.issue_context(issue) for issue in issue_matches]
         results = yield context_futures
-        raise ndb.Return(
-            results,
-            next_cursor,
-            more,
-        )
+        raise ndb.Return(results)
 
+    @ndb.toplevel
     def get(self):
-        self.user_key = users.user_key(self.user)
+        self.user_key = self.lookup_user_key()
         sort = (self.request.get('sort_key'), self.request.get('sort_order'))
         query = issues.Issue.query().order(
             self.order_keys.get(sort, issues.Issue.pubdate)
         )
-        count_future = query.count_async()
-        results, next_cursor, more = self.fetch_page(query).get_result()
-        if next_cursor:
-            position = next_cursor.urlsafe()
+        selected = fields.requested(self.request)
+        projection = None
+        if not self.request.get('context'):
+            projection = fields.projection(
+                issues.Issue, selected, order=['pubdate'])
+        try:
+            page = paging.PagedQuery.from_request(
+                query, self.request, default_limit=10,
+                projection=projection)
+        except paging.InvalidPage as error:
+            logging.info('Rejecting page request: %s', error)
+            self.abort(400)
+        count_future = paging.count_async(query, self.request.get('count'))
+        results, position, more = page.fetch_async(
+            self.page_context).get_result()
+        count = count_future.get_result()
+        if count is None:
+            message = 'issues found'
         else:
-            position = ''
+            message = '%d issues found' % count
         self.response.write(json.dumps({
             'status': 200,
-            'message': '%d issues found' % count_future.get_result(),
+            'message': message,
             'more_results': more,
             'next_page': position,
-            'results': list(results),
+            'results': [fields.trim(result, selected) for result in results],
         }))
 
-class RefreshIssue(OauthHandler):
+class RefreshIssue(ApiHandler):
     @ndb.tasklet
     def refresh_issue(self, issue):
-        cv_issue = self.cv.fetch_issue(issue.identifier)
+        # go to ComicVine, the result replaces the cached copy
+        cv_issue = self.cv.upstream('fetch_issue', (issue.identifier,))
         issue_key = issues.issue_key(cv_issue)
+        loader.invalidate([issue_key])
         issue = yield issue_key.get_async()
         raise ndb.Return({
             'issue': model_to_dict(issue),
         })
 
     def get(self, issue):
-        self.cv = comicvine.load()
+        self.cv = cvcache.load()
         query = issues.Issue.query(issues.Issue.identifier == int(issue))
         updated_issues = query.map(self.refresh_issue)
         if updated_issues:
@@ -147,9 +174,9 @@ class RefreshIssue(OauthHandler):
         logging.debug(status['message'])
         self.response.write(json.dumps(status))
 
-class Reindex(OauthHandler):
+class Reindex(ApiHandler):
     def get(self, identifier):
-        user = users.user_key(app_user=self.user).get()
+        user = self.lookup_user_key().get()
         if not user.trusted:
             logging.warn('Untrusted access attempt: %r', self.user)
             self.abort(401)
@@ -157,6 +184,7 @@ class Reindex(OauthHandler):
         issue = query.get()
         if issue:
             issue.index_document()
+            loader.invalidate([issue.key])
             response = {
                 'status': 200,
                 'message': 'Issue %s reindexed' % identifier,
@@ -168,7 +196,7 @@ class Reindex(OauthHandler):
             }
         self.response.write(json.dumps(response))
 
-class SearchIssues(OauthHandler):
+class SearchIssues(ApiHandler):
     def get(self):
         index = search.Index(name='issues')
         results = []
@@ -0,0 +1,130 @@
+'Shared helpers for batched entity loading'
+import logging
+
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from api import etags
+from api import lru
+from pulldb.models import issues
+from pulldb.models import pulls
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+ISSUE_KEY_TTL = 86400
+
+# Catalog entities are shared by all users and rarely change, so they
+# are kept in an instance-local cache in front of the datastore.  Loaded
+# entities take several times their pickled size in memory, so the byte
+# budget is kept well below the instance memory limit.
+CATALOG_KINDS = frozenset(['Issue', 'Volume', 'Publisher'])
+catalog = lru.LRUCache(maxsize=2000, ttl=600, maxbytes=4 * 1024 * 1024)
+
+def invalidate(keys):
+    for key in keys:
+        catalog.delete(key)
+    # issue listings are stamped per volume
+    etags.touch(volume_scopes(keys))
+
+def volume_scopes(keys):
+    return unique_keys(
+        key if key.kind() == 'Volume' else key.parent()
+        for key in keys if key.kind() in ('Issue', 'Volume'))
+
+def unique_keys(keys):
+    seen = set()
+    result = []
+    for key in keys:
+        if key and key not in seen:
+            seen.add(key)
+            result.append(key)
+    return result
+
+@ndb.tasklet
+def fetch_map_async(keys):
+    '''Fetch the distinct set of keys in one batch.
+
+    Returns a dict mapping each key to its entity (or None if missing).
+    Catalog entities are served from the local cache where possible.
+    '''
+    entity_map = {}
+    missing = []
+    for key in unique_keys(keys):
+        entity = None
+        if key.kind() in CATALOG_KINDS:
+            entity = catalog.get(key)
+        if entity:
+            entity_map[key] = entity
+        else:
+            missing.append(key)
+    if missing:
+        entities = yield ndb.get_multi_async(missing)
+        for key, entity in zip(missing, entities):
+            entity_map[key] = entity
+            if entity and key.kind() in CATALOG_KINDS:
+                catalog.set(key, entity)
+    raise ndb.Return(entity_map)
+
+@ndb.tasklet
+def get_async(key):
+    entity_map = yield fetch_map_async([key])
+    raise ndb.Return(entity_map.get(key))
+
+def issue_key_cache_key(identifier):
+    return 'issuekey:%d' % identifier
+
+@ndb.tasklet
+def resolve_issues_async(issue_ids, user_key=None):
+    '''Map issue identifiers to Issue entities using batched lookups.
+
+    Issue keys are taken from the user's existing pulls and from a
+    memcache map of identifier to key, then loaded with a single batch
+    get.  Only identifiers that cannot be mapped fall back to a query.
+    '''
+    identifiers = unique_keys(int(issue_id) for issue_id in issue_ids)
+    issue_keys = {}
+    if user_key:
+        user_pulls = yield ndb.get_multi_async([
+            pulls.pull_key(identifier, user=user_key, create=False)
+            for identifier in identifiers
+        ])
+        for identifier, pull in zip(identifiers, user_pulls):
+            if pull and pull.issue:
+                issue_keys[identifier] = pull.issue
+    unmapped = [
+        identifier for identifier in identifiers
+        if identifier not in issue_keys
+    ]
+    context = ndb.get_context()
+    if unmapped:
+        cached = yield [
+            context.memcache_get(issue_key_cache_key(identifier))
+            for identifier in unmapped
+        ]
+        for identifier, key in zip(unmapped, cached):
+            if key:
+                issue_keys[identifier] = ndb.Key(urlsafe=key)
+    found = yield fetch_map_async(issue_keys.values())
+    issue_dict = {
+        issue.identifier: issue for issue in found.values() if issue
+    }
+    missing = [
+        identifier for identifier in identifiers
+        if identifier not in issue_dict
+    ]
+    if missing:
+        logging.debug('Querying for %d unmapped issues', len(missing))
+        queried = yield [
+            issues.Issue.query(
+                issues.Issue.identifier == identifier).get_async()
+            for identifier in missing
+        ]
+        mapped = []
+        for issue in queried:
+            if issue:
+                issue_dict[issue.identifier] = issue
+                mapped.append(context.memcache_set(
+                    issue_key_cache_key(issue.identifier),
+                    issue.key.urlsafe(), time=ISSUE_KEY_TTL))
+        yield mapped
+    raise ndb.Return(issue_dict)
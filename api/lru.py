@@ -0,0 +1,69 @@
+'Thread safe, size bounded LRU cache with expiring entries'
+from collections import OrderedDict
+import cPickle as pickle
+import threading
+import time
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+def pickled_size(value):
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+class LRUCache(object):
+    '''Bounded by entry count and, when maxbytes is set, by approximate
+    size as measured by sizeof when an entry is set.'''
+    def __init__(self, maxsize=1000, ttl=None, maxbytes=None,
+                 sizeof=pickled_size):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._pop(key)
+            if entry is None:
+                return default
+            value, expires, size = entry
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.nbytes += size
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        size = self.sizeof(value) if self.maxbytes else 0
+        with self._lock:
+            self._pop(key)
+            if self.maxbytes and size > self.maxbytes:
+                return
+            self._entries[key] = (value, expires, size)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (
+                    self.maxbytes and self.nbytes > self.maxbytes):
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
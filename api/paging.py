@@ -0,0 +1,205 @@
+'Helpers for paginated list endpoints'
+import hashlib
+import logging
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from api import fields
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+APPROX_COUNT_TTL = 300
+MAX_LIMIT = 200
+PREFETCH_TTL = 60
+
+class InvalidPage(ValueError):
+    pass
+
+def describe_query(query):
+    '''Return a picklable description of a query.
+
+    Sort orders refuse to be pickled, so they are reduced to (property,
+    direction) pairs.  Filters pickle as they are.
+    '''
+    orders = query.orders
+    if orders is None:
+        orders = ()
+    elif not isinstance(orders, datastore_query.CompositeOrder):
+        orders = (orders,)
+    else:
+        orders = orders.orders
+    return (
+        query.app, query.namespace, query.kind, query.ancestor,
+        query.filters,
+        tuple((order.prop, order.direction) for order in orders),
+    )
+
+def build_query(description):
+    '''Rebuild a keys-only capable query from describe_query output.'''
+    app, namespace, kind, ancestor, filters, order_list = description
+    orders = [
+        datastore_query.PropertyOrder(name, direction)
+        for name, direction in order_list
+    ]
+    if not orders:
+        orders = None
+    elif len(orders) == 1:
+        orders = orders[0]
+    else:
+        orders = datastore_query.CompositeOrder(orders)
+    return ndb.Query(app=app, namespace=namespace, kind=kind,
+                     ancestor=ancestor, filters=filters, orders=orders)
+
+def query_digest(query):
+    return hashlib.md5(repr(describe_query(query))).hexdigest()
+
+def count_cache_key(query, scope=None):
+    if scope:
+        scope = scope.urlsafe()
+    return 'count:%s:%s' % (scope or 'global', query_digest(query))
+
+def generation_key(scope):
+    return 'pagegen:%s' % scope.urlsafe()
+
+def invalidate(scope):
+    '''Discard prefetched pages for a scope after its data changes.'''
+    memcache.incr(generation_key(scope), initial_value=0)
+
+@ndb.tasklet
+def count_async(query, mode='exact', scope=None):
+    '''Count query results according to the requested count mode.
+
+    'none' skips the count and returns None, 'approx' serves a recent
+    count from memcache, anything else runs the full count.
+    '''
+    if mode == 'none':
+        raise ndb.Return(None)
+    if mode == 'approx':
+        context = ndb.get_context()
+        cache_key = count_cache_key(query, scope)
+        count = yield context.memcache_get(cache_key)
+        if count is None:
+            count = yield query.count_async()
+            yield context.memcache_set(
+                cache_key, count, time=APPROX_COUNT_TTL)
+        raise ndb.Return(count)
+    count = yield query.count_async()
+    raise ndb.Return(count)
+
+class PagedQuery(object):
+    '''Fetch one page of a query and prefetch the page after it.
+
+    A task stores the keys of the following page in memcache and loads
+    the entities so they are warm in the ndb cache when the client asks
+    for the next position.
+    '''
+    def __init__(self, query, limit, position='', scope=None,
+                 projection=None):
+        self.query = query
+        self.limit = limit
+        self.position = position or ''
+        self.scope = scope
+        self.projection = projection
+
+    @classmethod
+    def from_request(cls, query, request, default_limit=100,
+                     max_limit=MAX_LIMIT, scope=None, projection=None,
+                     position=None):
+        '''Build a page from the limit and position request parameters.
+
+        position, if not None, overrides the position parameter.
+        '''
+        try:
+            limit = int(request.get('limit', default_limit))
+        except ValueError:
+            raise InvalidPage(
+                'Invalid limit %r' % request.get('limit'))
+        limit = min(max(limit, 1), max_limit)
+        if position is None:
+            position = request.get('position')
+        try:
+            Cursor(urlsafe=position)
+        except (datastore_errors.BadValueError, TypeError):
+            raise InvalidPage('Invalid position %r' % position)
+        return cls(query, limit, position=position, scope=scope,
+                   projection=projection)
+
+    @ndb.tasklet
+    def cache_key_async(self, position):
+        scope = 'global'
+        if self.scope:
+            generation = yield ndb.get_context().memcache_get(
+                generation_key(self.scope))
+            scope = '%s.%s' % (self.scope.urlsafe(), generation or 0)
+        raise ndb.Return('page:%s:%s:%d:%s' % (
+            scope, query_digest(self.query), self.limit, position))
+
+    @ndb.tasklet
+    def prefetch_async(self, position):
+        cursor = Cursor(urlsafe=position)
+        keys, next_cursor, more = yield self.query.fetch_page_async(
+            self.limit, start_cursor=cursor, keys_only=True)
+        cache_key, _ = yield (
+            self.cache_key_async(position),
+            ndb.get_multi_async(keys),
+        )
+        yield ndb.get_context().memcache_set(cache_key, {
+            'keys': [key.urlsafe() for key in keys],
+            'position': next_cursor.urlsafe() if next_cursor else '',
+            'more': more,
+        }, time=PREFETCH_TTL)
+
+    @ndb.tasklet
+    def fetch_async(self, callback=None):
+        '''Return (results, next_position, more) for the current page.
+
+        callback, if given, is a tasklet that turns the list of
+        entities on the page into the list of results.
+        '''
+        cached = None
+        if self.position:
+            cache_key = yield self.cache_key_async(self.position)
+            cached = yield ndb.get_context().memcache_get(cache_key)
+        if cached:
+            logging.debug('Serving prefetched page %s', self.position)
+            entities = yield ndb.get_multi_async(
+                [ndb.Key(urlsafe=key) for key in cached['keys']])
+            entities = [entity for entity in entities if entity]
+            position, more = cached['position'], cached['more']
+        else:
+            try:
+                entities, next_cursor, more = yield (
+                    self.query.fetch_page_async(
+                        self.limit, start_cursor=Cursor(urlsafe=self.position),
+                        projection=self.projection))
+            except datastore_errors.NeedIndexError:
+                if not self.projection:
+                    raise
+                fields.missing_index(self.query.kind, self.projection)
+                self.projection = None
+                entities, next_cursor, more = yield (
+                    self.query.fetch_page_async(
+                        self.limit,
+                        start_cursor=Cursor(urlsafe=self.position)))
+            position = next_cursor.urlsafe() if next_cursor else ''
+        if more and position:
+            # warm the next page from a task, as an ndb.toplevel handler
+            # would otherwise hold its response until the prefetch is done
+            deferred.defer(prefetch, describe_query(self.query), self.limit,
+                           self.scope, position)
+        if callback:
+            results = yield callback(entities)
+        else:
+            results = entities
+        raise ndb.Return(results, position, more)
+
+def prefetch(description, limit, scope, position):
+    page = PagedQuery(build_query(description), limit, scope=scope)
+    if memcache.get(page.cache_key_async(position).get_result()) is None:
+        page.prefetch_async(position).get_result()
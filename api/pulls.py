@@ -4,98 +4,203 @@ from functools import partial
 import json
 import logging
 
-from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 # pylint: disable=F0401
 
-from pulldb.base import create_app, OauthHandler, Route
+from api import changes
+from api import counters
+from api import etags
+from api import fields
+from api import loader
+from api import paging
+from api import streamcounts
+from api import unread
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
 from pulldb.models.base import model_to_dict
-from pulldb.models import issues
 from pulldb.models import pulls
 from pulldb.models import subscriptions
-from pulldb.models import users
 from pulldb.models import volumes
 
 # pylint: disable=W0232,E1101,R0903,R0201,C0103
 
 @ndb.tasklet
-def pull_context(pull, context=False):
-    issue_dict = {}
-    volume_dict = {}
+def pull_context(pull_list, context=False, selected=None):
+    entities = {}
     if context:
-        issue, volume = yield (
-            pull.issue.get_async(),
-            pull.volume.get_async(),
+        entities = yield loader.fetch_map_async(
+            [pull.issue for pull in pull_list] +
+            [pull.volume for pull in pull_list]
         )
-        issue_dict = model_to_dict(issue)
-        volume_dict = model_to_dict(volume)
-    raise ndb.Return({
-        'pull': model_to_dict(pull),
-        'issue': issue_dict,
-        'volume': volume_dict,
-    })
+    results = []
+    for pull in pull_list:
+        issue_dict = {}
+        volume_dict = {}
+        if context:
+            issue_dict = model_to_dict(entities.get(pull.issue))
+            volume_dict = model_to_dict(entities.get(pull.volume))
+        results.append(fields.trim({
+            'pull': model_to_dict(pull),
+            'issue': issue_dict,
+            'volume': volume_dict,
+        }, selected))
+    raise ndb.Return(results)
 
-class AddPulls(OauthHandler):
-    def post(self):
-        user_key = users.user_key(self.user)
-        request = json.loads(self.request.body)
-        issue_ids = request['issues']
-        results = defaultdict(list)
-        query = issues.Issue.query(
-            issues.Issue.identifier.IN(
-                [int(identifier) for identifier in issue_ids]
-            )
-        )
-        records = query.fetch()
-        issue_dict = {record.key.id(): record for record in records}
-        candidates = []
-        for issue_id in issue_ids:
-            issue = issue_dict.get(issue_id)
-            if issue:
-                try:
-                    pull_key = pulls.pull_key(
-                        issue, user=user_key, create=False)
-                    candidates.append((issue.key, pull_key))
-                except pulls.NoSuchIssue as error:
-                    logging.info(
-                        'Unable to add pull, issue %s/%r not found',
-                        issue_id, issue
-                    )
-                    results['failed'].append(issue_id)
-            else:
+def write_pulls(user_key, updated=(), deleted=()):
+    '''Persist pull changes and keep the derived per-user state in step.
+
+    updated is a sequence of (before, pull) pairs, where before is the
+    counters.pull_state() of the pull prior to modification.  deleted is
+    a sequence of pulls to remove.
+    '''
+    pending = []
+    seen = set()
+    for before, pull in updated:
+        # keep the earliest snapshot if a pull is listed more than once
+        if pull.key not in seen:
+            seen.add(pull.key)
+            pending.append((before, pull))
+    state_changes = [
+        (before, counters.pull_state(pull)) for before, pull in pending
+    ] + [
+        (counters.pull_state(pull), {}) for pull in deleted
+    ]
+    updated_pulls = [pull for before, pull in pending]
+    ndb.put_multi(
+        updated_pulls + changes.record_changes(updated_pulls, deleted))
+    ndb.delete_multi([pull.key for pull in deleted])
+    counters.apply_delta(user_key, counters.tally(state_changes))
+    streamcounts.apply_deltas(streamcounts.stream_deltas(state_changes))
+    unread.apply_changes(user_key, pending, deleted)
+    paging.invalidate(user_key)
+
+def fetch_pull_page(handler, query, user_key, restart=False):
+    '''Fetch the requested page of pulls, or the first if restart is set.'''
+    try:
+        page = paging.PagedQuery.from_request(
+            query, handler.request, scope=user_key,
+            position='' if restart else None)
+    except paging.InvalidPage as error:
+        logging.info('Rejecting page request: %s', error)
+        handler.abort(400)
+    context_callback = partial(
+        pull_context,
+        context=handler.request.get('context'),
+        selected=fields.requested(handler.request),
+    )
+    return page.fetch_async(context_callback)
+
+def plan_pulls(user_key, issue_ids):
+    '''Return per-item results and the new pulls for the given issues.'''
+    results = defaultdict(list)
+    issue_dict = loader.resolve_issues_async(
+        issue_ids, user_key=user_key).get_result()
+    candidates = []
+    for issue_id in issue_ids:
+        issue = issue_dict.get(int(issue_id))
+        if issue:
+            try:
+                pull_key = pulls.pull_key(
+                    issue, user=user_key, create=False)
+                candidates.append((issue.key, pull_key))
+            except pulls.NoSuchIssue as error:
                 logging.info(
                     'Unable to add pull, issue %s/%r not found',
-                    issue_id, issue)
-                results['failed'].append(issue_id)
-        # prefetch for efficiency
-        ndb.get_multi(pull for issue, pull in candidates)
-        new_pulls = []
-        for issue_key, pull_key in candidates:
-            if pull_key.get():
-                logging.info(
-                    'Unable to add pull, issue %s already pulled',
-                    issue_key.id()
+                    issue_id, issue
                 )
-                # Already exists
-                results['skipped'].append(pull_key.id())
-            else:
-                new_pulls.append(pulls.Pull(
-                    key=pull_key,
-                    issue=issue_key,
-                    read=False,
-                ))
-                results['added'].append(pull_key.id())
-        ndb.put_multi(new_pulls)
+                results['failed'].append(issue_id)
+        else:
+            logging.info(
+                'Unable to add pull, issue %s/%r not found',
+                issue_id, issue)
+            results['failed'].append(issue_id)
+    existing = ndb.get_multi(pull for issue, pull in candidates)
+    new_pulls = []
+    for (issue_key, pull_key), pull in zip(candidates, existing):
+        if pull:
+            logging.info(
+                'Unable to add pull, issue %s already pulled',
+                issue_key.id()
+            )
+            # Already exists
+            results['skipped'].append(pull_key.id())
+        else:
+            new_pulls.append(pulls.Pull(
+                key=pull_key,
+                issue=issue_key,
+                read=False,
+            ))
+            results['added'].append(pull_key.id())
+    return results, new_pulls
+
+def add_pulls(user_key, issue_ids):
+    '''Pull the given issues for a user, returning per-item results.'''
+    results, new_pulls = plan_pulls(user_key, issue_ids)
+    write_pulls(user_key, updated=[({}, pull) for pull in new_pulls])
+    return results
+
+class AddPulls(ApiHandler):
+    def post(self):
+        user_key = self.lookup_user_key()
+        request = json.loads(self.request.body)
         response = {
             'status': 200,
-            'results': results
+            'results': add_pulls(user_key, request['issues']),
         }
         self.response.write(json.dumps(response))
 
-class FetchPulls(OauthHandler):
+class PullChanges(ApiHandler):
+    def get(self):
+        user_key = self.lookup_user_key()
+        since = self.request.get('since')
+        if not since:
+            self.response.write(json.dumps({
+                'status': 200,
+                'message': 'No watermark given, run a full sync first',
+                'watermark': changes.current_watermark(),
+                'more': False,
+                'results': [],
+                'removed': [],
+            }))
+            return
+        try:
+            limit = min(max(int(self.request.get('limit', 500)), 1), 500)
+            entries, watermark, more = changes.changes_since_async(
+                user_key, since, limit=limit).get_result()
+        except changes.InvalidWatermark as error:
+            logging.info('Rejecting sync request: %s', error)
+            self.response.write(json.dumps({
+                'status': 410,
+                'message': 'Watermark expired or invalid, resync required',
+            }))
+            return
+        except ValueError:
+            self.abort(400)
+        removed = [entry.key.id() for entry in entries if entry.deleted]
+        modified = ndb.get_multi([
+            pulls.pull_key(entry.key.id(), user=user_key, create=False)
+            for entry in entries if not entry.deleted
+        ])
+        results = pull_context(
+            [pull for pull in modified if pull],
+            context=self.request.get('context'),
+            selected=fields.requested(self.request),
+        ).get_result()
+        self.response.write(json.dumps({
+            'status': 200,
+            'message': '%d changed, %d removed' % (
+                len(results), len(removed)),
+            'watermark': watermark,
+            'more': more,
+            'results': results,
+            'removed': removed,
+        }))
+
+class FetchPulls(ApiHandler):
     def post(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         request = json.loads(self.request.body)
         pull_keys = []
         for pull_id in request.get('ids', []):
@@ -114,16 +219,18 @@ class FetchPulls(OauthHandler):
             'results': pulls,
         }))
 
-class GetPull(OauthHandler):
+class GetPull(ApiHandler):
     def get(self, identifier):
-        self.user_key = users.user_key(self.user)
+        self.user_key = self.lookup_user_key()
         query = pulls.Pull.query(
             pulls.Pull.identifier == int(identifier),
             ancestor=self.user_key,
         )
-        context_callback = partial(
-            pull_context, context=self.request.get('context'))
-        results = query.map(context_callback)
+        results = pull_context(
+            query.fetch(),
+            context=self.request.get('context'),
+            selected=fields.requested(self.request),
+        ).get_result()
         if results:
             status = 200
             message = 'Found pull for %r' % identifier
@@ -136,59 +243,32 @@ class GetPull(OauthHandler):
             'results': results,
         }))
 
-class ListPulls(OauthHandler):
-    @ndb.tasklet
-    def fetch_page(self, query):
-        limit = self.request.get('limit', 100)
-        cursor = Cursor(urlsafe=self.request.get('position'))
-        pulls, next_cursor, more = yield query.fetch_page_async(
-            limit, start_cursor=cursor)
-        context_callback = partial(
-            pull_context, context=self.request.get('context'))
-        context_futures = map(context_callback, pulls)
-        results = yield context_futures
-        raise ndb.Return(
-            results,
-            next_cursor,
-            more,
-        )
-
+class ListPulls(ApiHandler):
+    @ndb.toplevel
     def get(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         query = pulls.Pull.query(ancestor=user_key)
-        count_future = query.count_async()
-        results, next_cursor, more = self.fetch_page(query).get_result()
-        if next_cursor:
-            position = next_cursor.urlsafe()
+        count_future = paging.count_async(
+            query, self.request.get('count'), scope=user_key)
+        results, position, more = fetch_pull_page(
+            self, query, user_key).get_result()
+        count = count_future.get_result()
+        if count is None:
+            message = 'pulls found'
         else:
-            position = ''
+            message = '%d pulls found' % count
         self.response.write(json.dumps({
             'status': 200,
-            'message': '%d pulls found' % count_future.get_result(),
+            'message': message,
             'more_results': more,
             'next_page': position,
             'results': list(results),
         }))
 
-class NewIssues(OauthHandler):
-    @ndb.tasklet
-    def fetch_page(self, query):
-        limit = self.request.get('limit', 100)
-        cursor = Cursor(urlsafe=self.request.get('position'))
-        pulls, next_cursor, more = yield query.fetch_page_async(
-            limit, start_cursor=cursor)
-        context_callback = partial(
-            pull_context, context=self.request.get('context'))
-        context_futures = map(context_callback, pulls)
-        results = yield context_futures
-        raise ndb.Return(
-            results,
-            next_cursor,
-            more,
-        )
-
+class NewIssues(ApiHandler):
+    @ndb.toplevel
     def get(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         if self.request.get('reverse'):
             sortkey = -pulls.Pull.pubdate
         else:
@@ -197,15 +277,18 @@ class NewIssues(OauthHandler):
             pulls.Pull.pulled == False,
             ancestor=user_key
         ).order(sortkey)
-        count_future = query.count_async()
-        new_pulls, next_cursor, more = self.fetch_page(query).get_result()
-        if next_cursor:
-            position = next_cursor.urlsafe()
+        count_future = paging.count_async(
+            query, self.request.get('count'), scope=user_key)
+        new_pulls, position, more = fetch_pull_page(
+            self, query, user_key).get_result()
+        count = count_future.get_result()
+        if count is None:
+            message = 'Found results'
         else:
-            position = ''
+            message = 'Found %d results' % count
         result = {
             'status': 200,
-            'message': 'Found %d results' % count_future.get_result(),
+            'message': message,
             'position': position,
             'more': more,
             'results': new_pulls,
@@ -213,34 +296,42 @@ class NewIssues(OauthHandler):
         self.response.write(json.dumps(result))
 
 
-class PullStats(OauthHandler):
+class PullStats(ApiHandler):
     def get(self):
-        user_key = users.user_key(self.user)
-        total_count = pulls.Pull.query(
-            ancestor=user_key).count_async()
-        new_count = pulls.Pull.query(
-            pulls.Pull.pulled == False,
-            ancestor=user_key).count_async()
-        unread_count = pulls.Pull.query(
-            pulls.Pull.pulled == True,
-            pulls.Pull.read == False,
-            ancestor=user_key).count_async()
-        read_count = pulls.Pull.query(
-            pulls.Pull.read == True,
-            ancestor=user_key).count_async()
+        user_key = self.lookup_user_key()
+        counter = counters.counter_key(user_key).get()
+        if not counter:
+            counter = counters.reconcile(user_key)
+        if self.not_modified(etags.entity_version(counter)):
+            return
         result = {
             'status': 200,
-            'counts': {
-                'new': new_count.get_result(),
-                'unread': unread_count.get_result(),
-                'read': read_count.get_result(),
-                'total': total_count.get_result(),
-            },
+            'counts': counter.counts(),
         }
         self.response.write(json.dumps(result))
 
+class ReconcileStats(ApiHandler):
+    def get(self):
+        user_key = self.lookup_user_key()
+        if self.request.get('all'):
+            user = user_key.get()
+            if not user.trusted:
+                logging.warn('Untrusted access attempt: %r', self.user)
+                self.abort(401)
+            deferred.defer(counters.reconcile_all)
+            message = 'Reconciling pull counts for all users'
+        else:
+            deferred.defer(counters.reconcile, user_key)
+            deferred.defer(unread.rebuild, user_key)
+            deferred.defer(changes.purge_changes, user_key)
+            message = 'Reconciling pull counts'
+        self.response.write(json.dumps({
+            'status': 200,
+            'message': message,
+        }))
 
-class RefreshPull(OauthHandler):
+
+class RefreshPull(ApiHandler):
     @ndb.tasklet
     def refresh_pull(self, pull):
         if pull.issue and not pull.volume:
@@ -254,7 +345,7 @@ class RefreshPull(OauthHandler):
                 })
 
     def get(self, identifier):
-        self.user_key = users.user_key(self.user)
+        self.user_key = self.lookup_user_key()
         query = pulls.Pull.query(
             pulls.Pull.identifier == int(identifier),
             ancestor=user_key
@@ -266,10 +357,10 @@ class RefreshPull(OauthHandler):
         }
         self.response.write(json.dumps(response))
 
-class RemovePulls(OauthHandler):
+class RemovePulls(ApiHandler):
     @ndb.toplevel
     def post(self):
-        user_key = users.user_key(self.user, create=False)
+        user_key = self.lookup_user_key(create=False)
         request = json.loads(self.request.body)
         issue_ids = request['issues']
         results = defaultdict(list)
@@ -281,10 +372,10 @@ class RemovePulls(OauthHandler):
         for issue_id, pull in zip(issue_ids, records):
             if pull:
                 results['removed'].append(issue_id)
-                candidates.append(pull.key)
+                candidates.append(pull)
             else:
                 results['skipped'].append(issue_id)
-        ndb.delete_multi(candidates)
+        write_pulls(user_key, deleted=candidates)
         response = {
             'status': 200,
             'message': 'Removed %d pulls' % len(results['removed']),
@@ -292,117 +383,140 @@ class RemovePulls(OauthHandler):
         }
         self.response.write(json.dumps(response))
 
-class UnreadIssues(OauthHandler):
+class UnreadIssues(ApiHandler):
     @ndb.tasklet
-    def fetch_page(self, query):
-        limit = self.request.get('limit', 100)
-        cursor = Cursor(urlsafe=self.request.get('position'))
-        pulls, next_cursor, more = yield query.fetch_page_async(
-            limit, start_cursor=cursor)
-        context_callback = partial(
-            pull_context, context=self.request.get('context'))
-        context_futures = map(context_callback, pulls)
-        results = yield context_futures
-        raise ndb.Return(
-            results,
-            next_cursor,
-            more,
+    def queue_page_async(self, queue, user_key):
+        '''Serve a page from the user's unread queue without a query.
+
+        Positions into the queue are offsets prefixed with "q".
+        '''
+        try:
+            limit = min(max(int(self.request.get('limit', 100)), 1),
+                        paging.MAX_LIMIT)
+            offset = int(self.request.get('position', 'q0')[1:] or 0)
+        except ValueError:
+            raise paging.InvalidPage(
+                'Invalid limit or position %r' % self.request.get('position'))
+        entries = queue.ordered(weighted=self.request.get('weighted'))
+        page = entries[offset:offset + limit]
+        unread_pulls = yield ndb.get_multi_async([
+            pulls.pull_key(pull_id, user=user_key, create=False)
+            for _, _, pull_id in page
+        ])
+        results = yield pull_context(
+            [pull for pull in unread_pulls
+             if counters.pull_state(pull).get('unread')],
+            context=self.request.get('context'),
+            selected=fields.requested(self.request),
         )
+        more = offset + limit < len(entries)
+        position = 'q%d' % (offset + limit) if more else ''
+        raise ndb.Return(results, position, more, len(entries))
 
+    @ndb.toplevel
     def get(self):
         if self.request.get('weighted'):
             sortkey = pulls.Pull.weight
         else:
             sortkey = pulls.Pull.pubdate
-        user_key = users.user_key(self.user)
-        query = pulls.Pull.query(
-            pulls.Pull.pulled == True,
-            pulls.Pull.read == False,
-            ancestor=user_key
-        ).order(sortkey)
-        count_future = query.count_async()
-        unread_pulls, next_cursor, more = self.fetch_page(query).get_result()
-        if next_cursor:
-            position = next_cursor.urlsafe()
+        user_key = self.lookup_user_key()
+        position = self.request.get('position')
+        from_queue = position.startswith('q')
+        queue = None
+        if not position or from_queue:
+            queue = unread.queue_key(user_key).get()
+            if not queue:
+                queue = unread.rebuild(user_key)
+        use_queue = queue and not queue.overflow
+        if use_queue:
+            try:
+                unread_pulls, position, more, count = self.queue_page_async(
+                    queue, user_key).get_result()
+            except paging.InvalidPage as error:
+                logging.info('Rejecting page request: %s', error)
+                self.abort(400)
         else:
-            position = ''
+            query = pulls.Pull.query(
+                pulls.Pull.pulled == True,
+                pulls.Pull.read == False,
+                ancestor=user_key
+            ).order(sortkey)
+            count_future = paging.count_async(
+                query, self.request.get('count'), scope=user_key)
+            # queue positions mean nothing to the query, so start over
+            unread_pulls, position, more = fetch_pull_page(
+                self, query, user_key, restart=from_queue).get_result()
+            count = count_future.get_result()
+        if count is None:
+            message = 'Found unread pulls'
+        else:
+            message = 'Found %d unread pulls' % count
+        if from_queue and not use_queue:
+            logging.info('Unread queue unavailable, restarting listing')
+            message += ', restarted from the first page'
         result = {
             'status': 200,
-            'message': 'Found %d unread pulls' % count_future.get_result(),
+            'message': message,
             'more': more,
             'position': position,
             'results': unread_pulls,
         }
         self.response.write(json.dumps(result))
 
-class UpdatePulls(OauthHandler):
+class UpdatePulls(ApiHandler):
+    # (operation, attribute, target value, updates, log message)
+    transitions = (
+        ('pull', 'pulled', True, {'pulled': True}, 'pulling %r'),
+        ('unpull', 'pulled', False, {'pulled': False}, 'unpulling %r'),
+        ('read', 'read', True, {'pulled': True, 'read': True},
+         'Reading %r'),
+        ('unread', 'read', False, {'read': False}, 'Unreading %r'),
+    )
+
     def post(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         request = json.loads(self.request.body)
         logging.debug('Decoded post data: %r' % request)
-        issue_ids = (
-            request.get('pull', []) +
-            request.get('unpull', []) +
-            request.get('read', []) +
-            request.get('unread', [])
-        )
+        operations = {}
+        for operation, _, _, _, _ in self.transitions:
+            operations[operation] = set(
+                int(issue_id) for issue_id in request.get(operation, []))
+        issue_ids = sorted(set().union(*operations.values()))
         results = defaultdict(list)
-        query = issues.Issue.query(issues.Issue.identifier.IN(
-            [int(identifier) for identifier in issue_ids]))
-        records = query.fetch()
-        issue_dict = {record.key.id(): record for record in records}
+        issue_dict = loader.resolve_issues_async(
+            issue_ids, user_key=user_key).get_result()
         candidates = []
         for issue_id in issue_ids:
-            issue = issue_dict.get(issue_id)
-            if issue:
-                pull_key = pulls.pull_key(issue_id, user=user_key)
-                candidates.append(pull_key)
+            if issue_id in issue_dict:
+                candidates.append(
+                    (issue_id, pulls.pull_key(issue_id, user=user_key)))
             else:
                 # no such issue
                 results['failed'].append(issue_id)
-        # prefetch for efficiency
-        ndb.get_multi(candidates)
         updated_pulls = []
-        for pull_key in candidates:
-            pull = pull_key.get()
-            if pull:
-                if pull.issue.id() in request.get('pull', []):
-                    if pull.pulled:
-                        results['skipped'].append(pull_key.id())
-                    else:
-                        results['updated'].append(pull_key.id())
-                        logging.info('pulling %r', pull.issue.id())
-                        pull.pulled = True
-                        updated_pulls.append(pull)
-                if pull.issue.id() in request.get('unpull', []):
-                    if pull.pulled:
-                        results['updated'].append(pull_key.id())
-                        logging.info('unpulling %r', pull.issue.id())
-                        pull.pulled = False
-                        updated_pulls.append(pull)
-                    else:
-                        results['skipped'].append(pull_key.id())
-                if pull.issue.id() in request.get('read', []):
-                    if pull.read:
-                        results['skipped'].append(pull_key.id())
-                    else:
-                        results['updated'].append(pull_key.id())
-                        logging.info('Reading %r', pull.issue.id())
-                        pull.pulled = True
-                        pull.read = True
-                        updated_pulls.append(pull)
-                if pull.issue.id() in request.get('unread', []):
-                    if pull.read:
-                        results['updated'].append(pull_key.id())
-                        logging.info('Unreading %r', pull.issue.id())
-                        pull.read = False
-                        updated_pulls.append(pull)
-                    else:
-                        results['skipped'].append(pull_key.id())
-            else:
+        records = ndb.get_multi([pull_key for _, pull_key in candidates])
+        for (issue_id, pull_key), pull in zip(candidates, records):
+            if not pull:
                 # No such pull
                 results['failed'].append(pull_key.id())
-        ndb.put_multi(updated_pulls)
+                continue
+            before = counters.pull_state(pull)
+            changed = False
+            for operation, attribute, value, updates, message in (
+                    self.transitions):
+                if issue_id not in operations[operation]:
+                    continue
+                if bool(getattr(pull, attribute)) == value:
+                    results['skipped'].append(pull_key.id())
+                    continue
+                results['updated'].append(pull_key.id())
+                logging.info(message, issue_id)
+                for name, change in updates.items():
+                    setattr(pull, name, change)
+                changed = True
+            if changed:
+                updated_pulls.append((before, pull))
+        write_pulls(user_key, updated=updated_pulls)
         response = {
             'status': 200,
             'results': results
@@ -411,6 +525,7 @@ class UpdatePulls(OauthHandler):
 
 app = create_app([
     Route('/api/pulls/add', AddPulls),
+    Route('/api/pulls/changes', PullChanges),
     Route('/api/pulls/fetch', FetchPulls),
     Route('/api/pulls/<identifier>/get', GetPull),
     Route('/api/pulls/<identifier>/refresh', RefreshPull),
@@ -419,5 +534,6 @@ app = create_app([
     Route('/api/pulls/list/unread', UnreadIssues),
     Route('/api/pulls/remove', RemovePulls),
     Route('/api/pulls/stats', PullStats),
+    Route('/api/pulls/stats/reconcile', ReconcileStats),
     Route('/api/pulls/update', UpdatePulls),
 ])
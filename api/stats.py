@@ -0,0 +1,28 @@
+'API endpoint exposing aggregated request statistics'
+import json
+import logging
+
+# pylint: disable=F0401
+from api import cvcache
+from api import instrument
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+class Stats(ApiHandler):
+    def get(self):
+        user = self.lookup_user_key().get()
+        if not user.trusted:
+            logging.warn('Untrusted access attempt: %r', self.user)
+            self.abort(401)
+        instrument.flush()
+        self.response.write(json.dumps({
+            'status': 200,
+            'routes': instrument.report(),
+            'comicvine_cache': cvcache.stats(),
+        }))
+
+app = create_app([
+    Route('/api/_stats', Stats),
+])
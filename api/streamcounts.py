@@ -0,0 +1,143 @@
+'Sharded per-stream pull counters'
+from collections import defaultdict
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from pulldb.models import pulls
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+NUM_SHARDS = 10
+STATES = ('length', 'unread')
+RECONCILE_LOCK_TTL = 300
+
+class StreamCounterShard(ndb.Model):
+    '''One shard of the counts for a stream.
+
+    Shards are root entities so that increments on a busy stream spread
+    across entity groups.  Shard 0 is written by reconcile and marks the
+    stream as tracked; until it exists increments are dropped.
+    '''
+    length = ndb.IntegerProperty(default=0, indexed=False)
+    unread = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+def shard_key(stream_key, index):
+    return ndb.Key(
+        StreamCounterShard, '%s|%d' % (stream_key.urlsafe(), index))
+
+def shard_keys(stream_key):
+    return [shard_key(stream_key, index) for index in range(NUM_SHARDS)]
+
+def stream_deltas(changes):
+    '''Return per-stream count changes for (before, after) pull states.'''
+    deltas = defaultdict(lambda: dict.fromkeys(STATES, 0))
+    for before, after in changes:
+        if before.get('stream') == after.get('stream') and (
+                before.get('unread') == after.get('unread')):
+            continue
+        if before.get('stream'):
+            deltas[before['stream']]['length'] -= 1
+            deltas[before['stream']]['unread'] -= before.get('unread', 0)
+        if after.get('stream'):
+            deltas[after['stream']]['length'] += 1
+            deltas[after['stream']]['unread'] += after.get('unread', 0)
+    return {
+        stream_key: delta for stream_key, delta in deltas.items()
+        if any(delta.values())
+    }
+
+@ndb.transactional_tasklet
+def increment_async(key, delta):
+    shard = yield key.get_async()
+    if not shard:
+        shard = StreamCounterShard(key=key)
+    for name in STATES:
+        setattr(shard, name, getattr(shard, name) + delta[name])
+    yield shard.put_async()
+
+@ndb.tasklet
+def apply_deltas_async(deltas):
+    stream_keys = list(deltas)
+    markers = yield ndb.get_multi_async(
+        [shard_key(stream_key, 0) for stream_key in stream_keys])
+    futures = []
+    for stream_key, marker in zip(stream_keys, markers):
+        if marker:
+            futures.append(increment_async(
+                shard_key(stream_key, random.randrange(NUM_SHARDS)),
+                deltas[stream_key]))
+    yield futures
+
+def apply_deltas(deltas):
+    if deltas:
+        apply_deltas_async(deltas).get_result()
+
+@ndb.tasklet
+def reconcile_async(stream_key):
+    '''Recount a stream from its pulls and reset the shards.'''
+    length, unread = yield (
+        pulls.Pull.query(
+            pulls.Pull.stream == stream_key,
+            ancestor=stream_key.parent()).count_async(),
+        pulls.Pull.query(
+            pulls.Pull.stream == stream_key,
+            pulls.Pull.pulled == True,
+            pulls.Pull.read == False,
+            ancestor=stream_key.parent()).count_async(),
+    )
+    shards = [
+        StreamCounterShard(key=key) for key in shard_keys(stream_key)]
+    shards[0].length = length
+    shards[0].unread = unread
+    yield ndb.put_multi_async(shards)
+    logging.info('Reconciled stream counts for %r: %d/%d',
+                 stream_key, unread, length)
+    raise ndb.Return({'length': length, 'unread': unread})
+
+def reconcile(stream_key):
+    reconcile_async(stream_key).get_result()
+
+def schedule_reconcile(stream_keys):
+    '''Queue a recount for streams that are not tracked yet.'''
+    for stream_key in stream_keys:
+        if memcache.add('streamcounts:%s' % stream_key.urlsafe(), 1,
+                        time=RECONCILE_LOCK_TTL):
+            deferred.defer(reconcile, stream_key)
+
+@ndb.tasklet
+def counts_multi_async(stream_keys):
+    '''Return counts for several streams from one batch of shard reads.
+
+    Streams without shards yet get None counts and a recount is queued
+    for them, so a read never waits on the count queries.
+    '''
+    stream_keys = list(stream_keys)
+    shards = yield ndb.get_multi_async([
+        key for stream_key in stream_keys for key in shard_keys(stream_key)])
+    results = {}
+    missing = []
+    for index, stream_key in enumerate(stream_keys):
+        stream_shards = shards[index * NUM_SHARDS:(index + 1) * NUM_SHARDS]
+        if not stream_shards[0]:
+            missing.append(stream_key)
+            results[stream_key] = dict.fromkeys(STATES)
+            continue
+        results[stream_key] = {
+            name: max(sum(
+                getattr(shard, name) for shard in stream_shards if shard), 0)
+            for name in STATES
+        }
+    if missing:
+        schedule_reconcile(missing)
+    raise ndb.Return(results)
+
+@ndb.tasklet
+def counts_async(stream_key):
+    results = yield counts_multi_async([stream_key])
+    raise ndb.Return(results[stream_key])
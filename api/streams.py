@@ -1,6 +1,5 @@
 'API endpoints for stream management'
 from collections import defaultdict
-from functools import partial
 import json
 import logging
 
@@ -8,46 +7,89 @@ from google.appengine.ext import ndb
 
 # pylint: disable=F0401
 
-from pulldb.base import create_app, OauthHandler, Route
+from api import etags
+from api import loader
+from api import streamcounts
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
 from pulldb.models.base import model_to_dict
 from pulldb.models import issues
 from pulldb.models import publishers
-from pulldb.models import pulls
 from pulldb.models import streams
-from pulldb.models import users
 from pulldb.models import volumes
 
 # pylint: disable=W0232,E1101,R0903,R0201,C0103
 
+MEMBER_LIMIT = 100
+MAX_MEMBER_LIMIT = 1000
+MEMBER_ATTRIBUTES = ('issues', 'volumes', 'publishers')
+
+def member_keys(stream, attribute, offset=0, limit=MEMBER_LIMIT):
+    '''Return a slice of a member list, or all of it if limit is None.'''
+    members = getattr(stream, attribute) or []
+    if limit is None:
+        return members[offset:]
+    return members[offset:offset + limit]
+
+def context_keys(stream_list, offset=0, limit=MEMBER_LIMIT):
+    '''Return the distinct member keys shown for a list of streams.'''
+    return loader.unique_keys(
+        key for stream in stream_list
+        for attribute in MEMBER_ATTRIBUTES
+        for key in member_keys(stream, attribute, offset, limit)
+    )
+
 @ndb.tasklet
-def stream_context(stream, context=False):
-    issue_list = []
-    volume_list = []
-    publisher__list = []
+def streams_context(stream_list, context=False, offset=0,
+                    limit=MEMBER_LIMIT):
+    '''Build results for a list of streams.
+
+    Member lists are sliced to offset and limit, and context for all of
+    the streams is fetched in one batch of distinct keys.
+    '''
+    entities = {}
     if context:
-        issues, volumes, publishers = yield (
-            ndb.get_multi_async(stream.issues or []),
-            ndb.get_multi_async(stream.volumes or []),
-            ndb.get_multi_async(stream.publishers or []),
+        entities, counts = yield (
+            loader.fetch_map_async(
+                context_keys(stream_list, offset, limit)),
+            streamcounts.counts_multi_async(
+                stream.key for stream in stream_list),
         )
-        issue_list = [model_to_dict(issue) for issue in issues]
-        volume_list = [model_to_dict(volume) for volume in volumes]
-        publishers_list = [
-            model_to_dict(publisher) for publisher in publishers]
     else:
-        issue_list = [key.id() for key in stream.issues]
-        volume_list = [key.id() for key in stream.issues]
-        publisher_list = [key.id() for key in stream.issues]
-    raise ndb.Return({
-        'stream': model_to_dict(stream),
-        'issues': issue_list,
-        'volumes': volume_list,
-        'publishers': publisher_list,
-    })
-
-class AddStreams(OauthHandler):
+        counts = yield streamcounts.counts_multi_async(
+            stream.key for stream in stream_list)
+    results = []
+    for stream in stream_list:
+        result = {
+            'stream': model_to_dict(stream),
+            'counts': counts[stream.key],
+            'totals': {},
+        }
+        # the stored length is only updated by a refresh
+        result['stream']['length'] = counts[stream.key]['length']
+        for attribute in MEMBER_ATTRIBUTES:
+            keys = member_keys(stream, attribute, offset, limit)
+            if context:
+                result[attribute] = [
+                    model_to_dict(entities.get(key)) for key in keys]
+            else:
+                result[attribute] = [key.id() for key in keys]
+            result['totals'][attribute] = len(
+                getattr(stream, attribute) or [])
+        results.append(result)
+    raise ndb.Return(results)
+
+def member_page(request):
+    try:
+        offset = max(int(request.get('member_offset', 0)), 0)
+        limit = int(request.get('member_limit', MEMBER_LIMIT))
+    except ValueError:
+        return 0, MEMBER_LIMIT
+    return offset, min(max(limit, 1), MAX_MEMBER_LIMIT)
+
+class AddStreams(ApiHandler):
     def post(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         request = json.loads(self.request.body)
         new_stream_list = request['streams']
         results = defaultdict(list)
@@ -71,19 +113,20 @@ class AddStreams(OauthHandler):
         }
         self.response.write(json.dumps(response))
 
-class GetStream(OauthHandler):
+class GetStream(ApiHandler):
     def get(self, identifier):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         query = streams.Stream.query(
             streams.Stream.name == identifier,
             ancestor=user_key,
         )
-        context_callback = partial(
-            stream_context, context=self.request.get('context'))
-        results = query.map(context_callback)
+        offset, limit = member_page(self.request)
+        results = streams_context(
+            query.fetch(), context=self.request.get('context'),
+            offset=offset, limit=limit).get_result()
         if results:
             status = 200
-            message = 'Stream %s found' % identifier,
+            message = 'Stream %s found' % identifier
         else:
             status = 404
             message = 'Stream %s not found' % identifier
@@ -93,139 +136,124 @@ class GetStream(OauthHandler):
             'results': results,
         }))
 
-class ListStreams(OauthHandler):
+class ListStreams(ApiHandler):
     def get(self):
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         query = streams.Stream.query(ancestor=user_key)
-        context_callback = partial(
-            stream_context, context=self.request.get('context'))
-        results = query.map(context_callback)
+        stream_list = query.fetch()
+        offset, limit = member_page(self.request)
+        context = self.request.get('context')
+        versions = [etags.entity_version(stream) for stream in stream_list]
+        count_map = streamcounts.counts_multi_async(
+            stream.key for stream in stream_list)
+        if context:
+            context_map = loader.fetch_map_async(
+                context_keys(stream_list, offset, limit)).get_result()
+            versions.extend(
+                etags.entity_version(entity)
+                for key, entity in sorted(context_map.items()))
+        versions.extend(
+            '%(unread)s/%(length)s' % counts
+            for key, counts in sorted(count_map.get_result().items()))
+        if self.not_modified(*versions):
+            return
+        # context entities are now held by the loader's catalog cache
+        results = streams_context(
+            stream_list, context=context, offset=offset,
+            limit=limit).get_result()
         self.response.write(json.dumps({
             'status': 200,
             'results': results,
         }))
 
-class RefreshStream(OauthHandler):
+class RefreshStream(ApiHandler):
     def get(self, identifier):
         results = []
-        user_key = users.user_key(self.user)
+        user_key = self.lookup_user_key()
         stream_key = streams.stream_key(
             identifier, user_key=user_key, create=False)
-        stream = stream.get()
+        stream = stream_key.get()
         if stream:
-            query = pull.Pulls.query(pulls.Pull.stream == stream_key)
-            pulls = query.fetch(keys_only=True)
-            stream.length = len(pulls)
+            counts = streamcounts.reconcile_async(stream_key).get_result()
+            stream.length = counts['length']
             stream.put()
             status = 200
-            message = 'Stream %s updated' % identifier,
+            message = 'Stream %s updated' % identifier
             results.append(model_to_dict(stream))
         else:
             status = 404
             message = 'Stream %s not found' % identifier
-        self.response.write({
+        self.response.write(json.dumps({
             'status': status,
             'message': message,
             'results': results,
-        })
-
-class UpdateStreams(OauthHandler):
-    def update_publishers(self, stream, updates):
-        for publisher_id in updates.get('add', []):
-            update_string = 'stream/%s/publisher/%s/add' % (
-                stream.name, publisher_id)
-            publisher_key = publishers.publisher_key(
-                publisher_id, create=False)
-            if publisher_key in stream.publishers:
-                self.results['skipped'].append(update_string)
-            else:
-                stream.publishers.append(publisher_key)
-                self.updated.append(stream)
-                self.results['successful'].append(update_string)
-        for publisher_id in updates.get('delete', []):
-            update_string = 'stream/%s/publisher/%s/del' % (
-                stream.name, publisher_id)
-            publisher_key = publishers.publisher_key(
-                publisher_id, create=False)
-            if publisher_key not in stream.publishers:
-                self.results['skipped'].append(update_string)
-            else:
-                stream.publishers.remove(publisher_key)
-                self.updated.append(stream)
-                self.results['successful'].append(update_string)
+        }))
 
-    def update_volumes(self, stream, updates):
-        for volume_id in updates.get('add', []):
-            update_string = 'stream/%s/volume/%s/add' % (
-                stream.name, volume_id)
-            volume_key = volumes.volume_key(
-                volume_id, create=False)
-            if volume_key in stream.volumes:
-                self.results['skipped'].append(update_string)
-            else:
-                stream.volumes.append(volume_key)
-                self.updated.append(stream)
-                self.results['successful'].append(update_string)
-        for volume_id in updates.get('delete', []):
-            update_string = 'stream/%s/volume/%s/del' % (
-                stream.name, volume_id)
-            volume_key = volumes.volume_key(
-                volume_id, create=False)
-            if volume_key not in stream.volumes:
-                self.results['skipped'].append(update_string)
-            else:
-                stream.volumes.remove(volume_key)
-                self.updated.append(stream)
-                self.results['successful'].append(update_string)
+class UpdateStreams(ApiHandler):
+    members = {
+        'publishers': ('publisher', publishers.publisher_key),
+        'volumes': ('volume', volumes.volume_key),
+        'issues': ('issue', issues.issue_key),
+    }
 
-    def update_issues(self, stream, updates):
-        for issue_id in updates.get('add', []):
-            update_string = 'stream/%s/issue/%s/add' % (
-                stream.name, issue_id)
-            issue_key = issues.issue_key(
-                issue_id, create=False)
-            if issue_key in stream.issues:
+    def update_members(self, stream, attribute, updates):
+        label, member_key = self.members[attribute]
+        current = getattr(stream, attribute) or []
+        present = set(current)
+        added = []
+        removed = set()
+        for member_id in updates.get('add', []):
+            update_string = 'stream/%s/%s/%s/add' % (
+                stream.name, label, member_id)
+            key = member_key(member_id, create=False)
+            if key in present:
                 self.results['skipped'].append(update_string)
             else:
-                stream.issues.append(issue_key)
-                self.updated.append(stream)
+                present.add(key)
+                added.append(key)
                 self.results['successful'].append(update_string)
-        for issue_id in updates.get('delete', []):
-            update_string = 'stream/%s/issue/%s/del' % (
-                stream.name, issue_id)
-            issue_key = issues.issue_key(
-                issue_id, create=False)
-            if issue_key not in stream.issues:
+        for member_id in updates.get('delete', []):
+            update_string = 'stream/%s/%s/%s/del' % (
+                stream.name, label, member_id)
+            key = member_key(member_id, create=False)
+            if key not in present:
                 self.results['skipped'].append(update_string)
             else:
-                stream.issues.remove(publisher_key)
-                self.updated.append(stream)
+                present.discard(key)
+                removed.add(key)
                 self.results['successful'].append(update_string)
+        if added or removed:
+            setattr(stream, attribute, [
+                member for member in current + added if member in present])
+            self.updated[stream.key] = stream
 
     def post(self):
         self.results = defaultdict(list)
-        self.updated = []
-        user_key = users.user_key(self.user)
+        self.updated = {}
+        user_key = self.lookup_user_key()
         request = json.loads(self.request.body)
-        for stream_updates in request:
-            stream = streams.stream_key(
+        stream_keys = [
+            streams.stream_key(
                 stream_updates['name'],
-                user_key = user_key,
+                user_key=user_key,
                 create=False,
-            ).get()
+            ) for stream_updates in request
+        ]
+        # the same stream may be named more than once
+        stream_map = dict(zip(stream_keys, ndb.get_multi(stream_keys)))
+        for stream_key, stream_updates in zip(stream_keys, request):
+            stream = stream_map[stream_key]
             if not stream:
                 self.results['failed'].append(stream_updates['name'])
                 continue
-            if stream_updates.get('publishers'):
-                self.update_publishers(stream, stream_updates['publishers'])
-            if stream_updates.get('volumes'):
-                self.update_volumes(stream, stream_updates['volumes'])
-            if stream_updates.get('issues'):
-                self.update_issues(stream, stream_updates['issues'])
+            for attribute in ('publishers', 'volumes', 'issues'):
+                if stream_updates.get(attribute):
+                    self.update_members(
+                        stream, attribute, stream_updates[attribute])
         if self.updated:
-            ndb.put_multi(self.updated)
+            ndb.put_multi(self.updated.values())
             status = 200
-            message = '%d stream changes' % len(self.updated)
+            message = '%d streams updated' % len(self.updated)
         else:
             status = 203
             message = 'no changes'
@@ -1,4 +1,5 @@
 from collections import defaultdict
+from functools import partial
 import json
 import logging
 
@@ -7,89 +8,189 @@ from dateutil.parser import parse as parse_date
 from google.appengine.ext import ndb
 
 # pylint: disable=F0401
-from pulldb.base import create_app, Route, OauthHandler
+from api import fields
+from api import loader
+from api import paging
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
 from pulldb.models.base import model_to_dict
 from pulldb.models import subscriptions
-from pulldb.models import users
 from pulldb.models import volumes
 
 # pylint: disable=W0232,E1101,R0903,C0103
 
-class AddSubscriptions(OauthHandler):
+@ndb.tasklet
+def subscription_context(subscription_list, context=False, selected=None):
+    '''Build results for a page of subscriptions.
+
+    Context is loaded in two batches: the volumes on the page, then the
+    distinct publishers of those volumes.
+    '''
+    volume_map = {}
+    publisher_map = {}
+    if context:
+        volume_map = yield loader.fetch_map_async(
+            subscription.volume for subscription in subscription_list)
+        publisher_map = yield loader.fetch_map_async(
+            volume.publisher for volume in volume_map.values() if volume)
+    results = []
+    for subscription in subscription_list:
+        volume_dict = {}
+        publisher_dict = {}
+        if context:
+            volume = volume_map.get(subscription.volume)
+            volume_dict = model_to_dict(volume)
+            if volume:
+                publisher_dict = model_to_dict(
+                    publisher_map.get(volume.publisher))
+        results.append(fields.trim({
+            'subscription': model_to_dict(subscription),
+            'volume': volume_dict,
+            'publisher': publisher_dict,
+        }, selected))
+    raise ndb.Return(results)
+
+@ndb.tasklet
+def plan_subscriptions_async(user_key, volume_ids):
+    '''Return per-item results and the new subscriptions for volumes.
+
+    The existing subscription and volume lookups run concurrently.
+    '''
+    results = defaultdict(list)
+    keys = [
+        subscriptions.subscription_key(
+            volume_id, user=user_key, create=False
+        ) for volume_id in volume_ids
+    ]
+    volume_keys = [
+        volumes.volume_key(key.id(), create=False) for key in keys
+    ]
+    existing, volume_map = yield (
+        ndb.get_multi_async(keys),
+        loader.fetch_map_async(volume_keys),
+    )
+    subs = []
+    for key, subscription, volume_key in zip(keys, existing, volume_keys):
+        if subscription:
+            results['skipped'].append(key.id())
+        elif volume_map.get(volume_key):
+            subs.append(subscriptions.subscription_key(
+                volume_key, user=user_key, create=True, batch=True))
+            results['added'].append(volume_key.id())
+        else:
+            results['failed'].append(volume_key.id())
+    logging.info('%d added, %d volumes', len(subs), len(volume_ids))
+    raise ndb.Return(results, subs)
+
+@ndb.tasklet
+def add_subscriptions_async(user_key, volume_ids):
+    '''Subscribe a user to the given volumes, returning per-item results.
+
+    New subscriptions are written in one batch.
+    '''
+    results, subs = yield plan_subscriptions_async(user_key, volume_ids)
+    yield ndb.put_multi_async(subs)
+    paging.invalidate(user_key)
+    raise ndb.Return(results)
+
+def add_subscriptions(user_key, volume_ids):
+    return add_subscriptions_async(user_key, volume_ids).get_result()
+
+class AddSubscriptions(ApiHandler):
     def post(self):
-        user_key = users.user_key(self.user, create=False)
+        user_key = self.lookup_user_key(create=False)
         request = json.loads(self.request.body)
         volume_ids = request['volumes']
-        logging.info('Adding volumes: %r', volume_ids);
-        results = defaultdict(list)
-        keys = [
-            subscriptions.subscription_key(
-                volume_id, user=user_key, create=False
-            ) for volume_id in volume_ids
-        ]
-        # prefetch for efficiency
-        ndb.get_multi(keys)
-        candidates = []
-        for key in keys:
-            volume = key.get()
-            if volume:
-                results['skipped'].append(key.id())
-            else:
-                candidates.append(key)
-        logging.info('%d candidates, %d volumes', len(candidates),
-                     len(volume_ids))
-        # prefetch for efficiency
-        ndb.get_multi(candidates)
-        subs = []
-        for subscription_key in candidates:
-            volume_key = volumes.volume_key(
-                subscription_key.id(), create=False
-            )
-            if volume_key.get():
-                subs.append(subscriptions.subscription_key(
-                    volume_key, user=user_key, create=True, batch=True))
-                results['added'].append(volume_key.id())
-            else:
-                results['failed'].append(volume_key.id())
-        ndb.put_multi(subs)
+        logging.info('Adding volumes: %r', volume_ids)
+        results = add_subscriptions(user_key, volume_ids)
         response = {
             'status': 200,
-            'message': 'added %d subscriptions' % len(candidates),
+            'message': 'added %d subscriptions' % len(results['added']),
             'results': results,
         }
         self.response.write(json.dumps(response))
 
-class ListSubs(OauthHandler):
+class ListSubs(ApiHandler):
+    orders = {
+        '': None,
+        'start_date': subscriptions.Subscription.start_date,
+        '-start_date': -subscriptions.Subscription.start_date,
+    }
+
     @ndb.tasklet
-    def subscription_context(self, subscription):
-        volume_dict = {}
-        publisher_dict = {}
-        if self.request.get('context'):
-            volume = yield subscription.volume.get_async()
-            publisher = yield volume.publisher.get_async()
-            volume_dict = model_to_dict(volume)
-            subscriptions_dict = model_to_dict(subscription)
-        raise ndb.Return({
-            'subscription': model_to_dict(subscription),
-            'volume': volume_dict,
-            'publisher': publisher_dict,
-        })
+    def page_by_name_async(self, query, callback):
+        '''Return a page of subscriptions ordered by volume name.
+
+        Volume names live on the volumes, so the whole subscription list
+        is sorted in memory and position is an offset into it.
+        '''
+        try:
+            limit = min(max(int(self.request.get('limit', 100)), 1),
+                        paging.MAX_LIMIT)
+            offset = max(int(self.request.get('position') or 0), 0)
+        except ValueError:
+            raise paging.InvalidPage('Invalid limit or position')
+        subscription_list = yield query.fetch_async()
+        volume_map = yield loader.fetch_map_async(
+            subscription.volume for subscription in subscription_list)
+        def volume_name(subscription):
+            volume = volume_map.get(subscription.volume)
+            return (volume.name or '').lower() if volume else ''
+        subscription_list.sort(
+            key=volume_name,
+            reverse=self.request.get('order').startswith('-'),
+        )
+        results = yield callback(subscription_list[offset:offset + limit])
+        more = offset + limit < len(subscription_list)
+        position = str(offset + limit) if more else ''
+        raise ndb.Return(results, position, more)
 
+    @ndb.toplevel
     def get(self):
-        user_key = users.user_key(self.user, create=False)
+        user_key = self.lookup_user_key(create=False)
+        order = self.request.get('order', '')
         query = subscriptions.Subscription.query(ancestor=user_key)
-        results = query.map(self.subscription_context)
+        count_future = paging.count_async(
+            query, self.request.get('count'), scope=user_key)
+        selected = fields.requested(self.request)
+        callback = partial(
+            subscription_context,
+            context=self.request.get('context'),
+            selected=selected,
+        )
+        try:
+            if order in ('name', '-name'):
+                page = self.page_by_name_async(query, callback)
+            elif order in self.orders:
+                projection = None
+                if self.orders[order] is not None:
+                    query = query.order(self.orders[order])
+                if not self.request.get('context'):
+                    projection = fields.projection(
+                        subscriptions.Subscription, selected,
+                        order=['start_date'] if order else [])
+                page = paging.PagedQuery.from_request(
+                    query, self.request, scope=user_key,
+                    projection=projection).fetch_async(callback)
+            else:
+                raise paging.InvalidPage('Invalid order %r' % order)
+            results, position, more = page.get_result()
+        except paging.InvalidPage as error:
+            logging.info('Rejecting page request: %s', error)
+            self.abort(400)
         response = {
             'status': 200,
-            'count': len(results),
+            'count': count_future.get_result(),
+            'more_results': more,
+            'next_page': position,
             'results': results,
         }
         self.response.write(json.dumps(response))
 
-class RemoveSubscriptions(OauthHandler):
+class RemoveSubscriptions(ApiHandler):
     @ndb.toplevel
     def post(self):
-        user_key = users.user_key(self.user, create=False)
+        user_key = self.lookup_user_key(create=False)
         request = json.loads(self.request.body)
         volume_ids = request['volumes']
         logging.info('Removing subscriptions: %r', volume_ids);
@@ -112,6 +213,7 @@ class RemoveSubscriptions(OauthHandler):
                      len(volume_ids))
         # prefetch for efficiency
         ndb.delete_multi_async(candidates)
+        paging.invalidate(user_key)
         response = {
             'status': 200,
             'message': 'removed %d subscriptions' % len(candidates),
@@ -119,9 +221,9 @@ class RemoveSubscriptions(OauthHandler):
         }
         self.response.write(json.dumps(response))
 
-class UpdateSubs(OauthHandler):
+class UpdateSubs(ApiHandler):
     def post(self):
-        user_key = users.user_key(self.user, create=False)
+        user_key = self.lookup_user_key(create=False)
         request = json.loads(self.request.body)
         updates = request.get('updates', [])
         results = defaultdict(list)
@@ -147,6 +249,7 @@ class UpdateSubs(OauthHandler):
                 logging.debug('Not subscribed to volume %r', key)
                 results['failed'].append(key.id())
         ndb.put_multi(updated_subs)
+        paging.invalidate(user_key)
         response = {
             'status': 200,
             'results': results
@@ -0,0 +1,94 @@
+'Materialized per-user queue of unread pulls'
+import logging
+
+from google.appengine.ext import ndb
+
+# pylint: disable=F0401
+from api import counters
+from pulldb.models import pulls
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+# Past this size the queue risks the entity size limit and readers fall
+# back to querying.
+MAX_ENTRIES = 10000
+
+class UnreadQueue(ndb.Model):
+    '''Unread pulls for a user as (weight, pubdate, pull id) entries.
+
+    Entries are kept sorted by pubdate.  Updates are transactional, so
+    concurrent pull writes for a user are applied one after another.
+    '''
+    entries = ndb.JsonProperty(compressed=True)
+    overflow = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def ordered(self, weighted=False):
+        if weighted:
+            return sorted(self.entries or [])
+        return self.entries or []
+
+def queue_key(user_key):
+    return ndb.Key(UnreadQueue, 'unread', parent=user_key)
+
+def entry(pull):
+    pubdate = pull.pubdate.isoformat() if pull.pubdate else None
+    return [pull.weight, pubdate, pull.key.id()]
+
+def pubdate_order(item):
+    return item[1], item[2]
+
+def store(queue, entries):
+    if len(entries) > MAX_ENTRIES:
+        logging.info('Unread queue for %r overflowed with %d entries',
+                     queue.key.parent(), len(entries))
+        queue.entries = []
+        queue.overflow = True
+    else:
+        queue.entries = sorted(entries, key=pubdate_order)
+        queue.overflow = False
+
+@ndb.transactional_tasklet
+def update_async(user_key, removed, added):
+    queue = yield queue_key(user_key).get_async()
+    if not queue or queue.overflow:
+        # Rebuilt in full on the next read or reconcile
+        raise ndb.Return(None)
+    entries = [
+        item for item in queue.entries or [] if item[2] not in removed]
+    store(queue, entries + added)
+    yield queue.put_async()
+    raise ndb.Return(queue)
+
+def apply_changes(user_key, updated=(), deleted=()):
+    '''Update the queue for pulls written by write_pulls.
+
+    updated is a sequence of (before, pull) pairs as passed to
+    write_pulls, deleted a sequence of removed pulls.
+    '''
+    removed = set()
+    added = []
+    for before, pull in updated:
+        unread = counters.pull_state(pull)['unread']
+        if before.get('unread') or unread:
+            # re-adding picks up any weight or pubdate change
+            removed.add(pull.key.id())
+        if unread:
+            added.append(entry(pull))
+    for pull in deleted:
+        if counters.pull_state(pull)['unread']:
+            removed.add(pull.key.id())
+    if removed or added:
+        update_async(user_key, removed, added).get_result()
+
+def rebuild(user_key):
+    query = pulls.Pull.query(
+        pulls.Pull.pulled == True,
+        pulls.Pull.read == False,
+        ancestor=user_key)
+    queue = UnreadQueue(key=queue_key(user_key))
+    store(queue, [entry(pull) for pull in query.iter(batch_size=500)])
+    queue.put()
+    logging.info('Rebuilt unread queue for %r: %d entries',
+                 user_key, len(queue.entries))
+    return queue
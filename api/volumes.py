@@ -3,24 +3,34 @@ from collections import defaultdict
 import json
 import logging
 import re
+import threading
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import search
 from google.appengine.ext import ndb
 
 # pylint: disable=F0401
-from pulldb.base import create_app, Route, OauthHandler
+from api import cvcache
+from api import etags
+from api import fields
+from api import loader
+from api import paging
+from api.base import ApiHandler
+from pulldb.base import create_app, Route
 from pulldb.models.base import model_to_dict
-from pulldb.models import comicvine
 from pulldb.models import issues
 from pulldb.models import subscriptions
-from pulldb.models import users
 from pulldb.models import volumes
 
 # pylint: disable=W0232,E1101,R0903,C0103
 
-class AddVolumes(OauthHandler):
+CV_BATCH_SIZE = 100
+STREAM_BATCH_SIZE = 100
+STREAM_MAX_ISSUES = 2000
+
+class AddVolumes(ApiHandler):
     def post(self):
-        cv = comicvine.load()
+        cv = cvcache.load()
         request = json.loads(self.request.body)
         volume_ids = request['volumes']
         results = defaultdict(list)
@@ -40,6 +50,7 @@ class AddVolumes(OauthHandler):
         cv_volumes = cv.fetch_volume_batch(candidates)
         for cv_volume in cv_volumes:
             key = volumes.volume_key(cv_volume)
+            loader.invalidate([key])
             if key.get():
                 results['added'].append(key.id())
             else:
@@ -50,9 +61,9 @@ class AddVolumes(OauthHandler):
         }
         self.response.write(json.dumps(response))
 
-class DropIndex(OauthHandler):
+class DropIndex(ApiHandler):
     def get(self, doc_id):
-        user = users.user_key(app_user=self.user).get()
+        user = self.lookup_user_key().get()
         if not user.trusted:
             logging.warn('Untrusted access attempt: %r', self.user)
             self.abort(401)
@@ -73,15 +84,15 @@ class DropIndex(OauthHandler):
             }
         self.response.write(json.dumps(response))
 
-class GetVolume(OauthHandler):
+class GetVolume(ApiHandler):
     @ndb.tasklet
     def volume_context(self, volume):
         publisher_dict = {}
         subscription_dict = {}
         if self.request.get('context'):
-            user_key = users.user_key(app_user=self.user)
+            user_key = self.lookup_user_key()
             publisher, subscription = yield (
-                volume.publisher.get_async(),
+                loader.get_async(volume.publisher),
                 subscriptions.subscription_key(
                     volume.key, user=user_key, create=False).get_async())
             publisher_dict = model_to_dict(publisher)
@@ -97,8 +108,30 @@ class GetVolume(OauthHandler):
         query = volumes.Volume.query(
             volumes.Volume.identifier == int(identifier)
         )
-        volume_list = query.map(self.volume_context)
-        if volumes:
+        volume_entities = query.fetch()
+        versions = [etags.entity_version(volume) for volume in volume_entities]
+        if self.request.get('context'):
+            user_key = self.lookup_user_key()
+            context_map = loader.fetch_map_async([
+                volume.publisher for volume in volume_entities
+            ] + [
+                subscriptions.subscription_key(
+                    volume.key, user=user_key, create=False)
+                for volume in volume_entities
+            ]).get_result()
+            versions.extend(
+                etags.entity_version(entity)
+                for key, entity in sorted(context_map.items()))
+        if self.not_modified(*versions):
+            return
+        selected = fields.requested(self.request)
+        context_futures = [
+            self.volume_context(volume) for volume in volume_entities]
+        volume_list = [
+            fields.trim(future.get_result(), selected)
+            for future in context_futures
+        ]
+        if volume_list:
             status = 200
             message = '%d matching volumes found' % len(volume_list)
         else:
@@ -110,7 +143,77 @@ class GetVolume(OauthHandler):
             'results': volume_list,
         }))
 
-class Issues(OauthHandler):
+class Issues(ApiHandler):
+    def page_issues(self, volume, query, selected=None, projection=None):
+        try:
+            page = paging.PagedQuery.from_request(
+                query, self.request, projection=projection)
+        except paging.InvalidPage as error:
+            logging.info('Rejecting page request: %s', error)
+            self.abort(400)
+        count_future = paging.count_async(query, self.request.get('count'))
+        results, position, more = page.fetch_async().get_result()
+        count = count_future.get_result()
+        if count is None:
+            message = 'Found issues'
+        else:
+            message = 'Found %d issues' % count
+        self.response.write(json.dumps({
+            'status': 200,
+            'message': message,
+            'volume': fields.select(model_to_dict(volume), selected),
+            'more': more,
+            'position': position,
+            'results': [
+                fields.select(model_to_dict(issue), selected)
+                for issue in results
+            ],
+        }))
+
+    def stream_issues(self, volume, query, selected=None, projection=None):
+        # Serialise the result list a batch at a time.  The response is
+        # still buffered by the runtime, so the listing is capped and the
+        # client continues from the returned position with paged requests.
+        issue_iterator = query.iter(batch_size=STREAM_BATCH_SIZE,
+                                    projection=projection,
+                                    produce_cursors=True)
+        try:
+            # runs the first batch before any output is written
+            issue_iterator.has_next()
+        except datastore_errors.NeedIndexError:
+            if not projection:
+                raise
+            fields.missing_index(query.kind, projection)
+            issue_iterator = query.iter(batch_size=STREAM_BATCH_SIZE,
+                                        produce_cursors=True)
+        self.response.write(
+            '{"status": 200, "volume": %s, "results": [' % json.dumps(
+                fields.select(model_to_dict(volume), selected)))
+        count = 0
+        batch = []
+        while count + len(batch) < STREAM_MAX_ISSUES and (
+                issue_iterator.has_next()):
+            batch.append(json.dumps(
+                fields.select(model_to_dict(issue_iterator.next()),
+                              selected)))
+            if len(batch) == STREAM_BATCH_SIZE:
+                self.response.write((', ' if count else '') + ', '.join(batch))
+                count += len(batch)
+                batch = []
+        if batch:
+            self.response.write((', ' if count else '') + ', '.join(batch))
+            count += len(batch)
+        position = ''
+        more = issue_iterator.has_next()
+        if more:
+            position = issue_iterator.cursor_after().urlsafe()
+        logging.debug('Query returned %d results', count)
+        self.response.write(
+            '], "more": %s, "position": %s, "message": %s}' % (
+                json.dumps(more), json.dumps(position),
+                json.dumps('Found %d issues' % count)))
+
+    @ndb.toplevel
     def get(self, identifier):
         volume = volumes.volume_key(identifier, create=False).get()
         if volume:
@@ -118,14 +221,18 @@ class Issues(OauthHandler):
                 ancestor=volume.key
             ).order(issues.Issue.pubdate)
             logging.debug('Looking for issues: %r', query)
-            results = query.fetch()
-            logging.debug('Query returned %d results', len(results))
-            response = {
-                'status': 200,
-                'message': 'Found %d issues' % len(results),
-                'volume': model_to_dict(volume),
-                'results': [model_to_dict(issue) for issue in results],
-            }
+            # Issues are children of their volume, so the volume update
+            # time and its change counter cover the whole listing.
+            if self.not_modified(etags.update_time(volume),
+                                 etags.collection_version(volume.key)):
+                return
+            selected = fields.requested(self.request)
+            projection = fields.projection(
+                issues.Issue, selected, order=['pubdate'])
+            if self.request.get('limit') or self.request.get('position'):
+                self.page_issues(volume, query, selected, projection)
+            else:
+                self.stream_issues(volume, query, selected, projection)
         else:
             logging.info('Volume %s not foune', identifier)
             response = {
@@ -133,11 +240,11 @@ class Issues(OauthHandler):
                 'message': 'Volume %s not found' % identifier,
                 'results': [],
             }
-        self.response.write(json.dumps(response))
+            self.response.write(json.dumps(response))
 
-class Reindex(OauthHandler):
+class Reindex(ApiHandler):
     def get(self, identifier):
-        user = users.user_key(app_user=self.user).get()
+        user = self.lookup_user_key().get()
         if not user.trusted:
             logging.warn('Untrusted access attempt: %r', self.user)
             self.abort(401)
@@ -145,6 +252,7 @@ class Reindex(OauthHandler):
         volume = volume_key.get()
         if volume:
             volumes.index_volume(volume_key, volume)
+            loader.invalidate([volume_key])
             response = {
                 'status': 200,
                 'message': 'Volume %s reindexed' % identifier,
@@ -156,45 +264,88 @@ class Reindex(OauthHandler):
             }
         self.response.write(json.dumps(response))
 
-class SearchComicvine(OauthHandler):
+class SearchComicvine(ApiHandler):
+    def fetch_volumes(self, cv, volume_ids):
+        chunks = [
+            volume_ids[index:index + CV_BATCH_SIZE]
+            for index in range(0, len(volume_ids), CV_BATCH_SIZE)
+        ]
+        if len(chunks) < 2:
+            return cv.fetch_volume_batch(volume_ids) if volume_ids else []
+        responses = [None] * len(chunks)
+        errors = []
+        def fetch_chunk(index, chunk):
+            try:
+                responses[index] = cv.fetch_volume_batch(chunk)
+            except Exception as error: # pylint: disable=W0703
+                errors.append(error)
+        threads = [
+            threading.Thread(target=fetch_chunk, args=(index, chunk))
+            for index, chunk in enumerate(chunks)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        results = []
+        for response in responses:
+            results.extend(response)
+        return results
+
+    def ensure_volumes(self, results):
+        volume_keys = []
+        for result in results:
+            try:
+                volume_keys.append(
+                    volumes.volume_key(result['id'], create=False))
+            except (KeyError, TypeError):
+                volume_keys.append(None)
+        existing = loader.fetch_map_async(volume_keys).get_result()
+        for result, volume_key in zip(results, volume_keys):
+            if volume_key and existing.get(volume_key):
+                continue
+            try:
+                volumes.volume_key(result)
+            except TypeError as error:
+                logging.warn(
+                    'Unable to lookup volume key for result %r (%r)',
+                    result, error)
+
     def get(self):
-        cv = comicvine.load()
+        cv = cvcache.load()
         query = self.request.get('q')
         volume_ids = self.request.get('volume_ids')
-        page = int(self.request.get('page', 0))
-        limit = int(self.request.get('limit', 20))
+        try:
+            page = max(int(self.request.get('page', 0)), 0)
+            limit = int(self.request.get('limit', 20))
+        except ValueError:
+            logging.info('Rejecting search with page %r and limit %r',
+                         self.request.get('page'), self.request.get('limit'))
+            self.abort(400)
+        # bounds the number of comicvine batches fetched in parallel
+        limit = min(max(limit, 1), paging.MAX_LIMIT)
         offset = page * limit
+        results_count = 0
+        results_page = []
         if volume_ids:
             volume_ids = [
                 int(identifier) for identifier in re.findall(
                     r'(\d+)', volume_ids)
             ]
-            logging.debug('Found volume ids: %r', volumes)
-            results = []
-            for index in range(0, len(volume_ids), 100):
-                volume_page = volume_ids[
-                    index:min([index+100, len(volume_ids)])]
-                results.extend(cv.fetch_volume_batch(volume_page))
-            results_count = len(results)
-            logging.debug('Found volumes: %r', results)
+            logging.debug('Found volume ids: %r', volume_ids)
+            results_count = len(volume_ids)
+            results_page = self.fetch_volumes(
+                cv, volume_ids[offset:offset + limit])
+            logging.debug('Found volumes: %r', results_page)
         elif query:
-            results_count, results = cv.search_volume(
+            results_count, results_page = cv.search_volume(
                 query, page=page, limit=limit)
-            logging.debug('Found volumes: %r', results)
-        if offset + limit > results_count:
-            page_end = results_count
-        else:
-            page_end = offset + limit
-        logging.info('Retrieving results %d-%d / %d', offset, page_end,
-                     results_count)
-        results_page = results[offset:page_end]
-        for result in results_page:
-            try:
-                volume_id = volumes.volume_key(result)
-            except TypeError as error:
-                logging.warn(
-                    'Unable to lookup volume key for result %r (%r)',
-                    result, error)
+            logging.debug('Found volumes: %r', results_page)
+        logging.info('Retrieving results %d-%d / %d', offset,
+                     offset + len(results_page), results_count)
+        self.ensure_volumes(results_page)
 
         self.response.write(json.dumps({
             'status': 200,
@@ -202,7 +353,7 @@ class SearchComicvine(OauthHandler):
             'results': results_page,
         }))
 
-class SearchVolumes(OauthHandler):
+class SearchVolumes(ApiHandler):
     def get(self):
         index = search.Index(name='volumes')
         results = []
@@ -1,5 +1,6 @@
 import logging
 import os
+import random
 import site
 import sys
 
@@ -7,7 +8,15 @@ approot = os.path.dirname(__file__)
 sys.path.append(os.path.join(approot, 'common'))
 sys.path.append(os.path.join(approot, 'lib'))
 
+# Record one in every APPSTATS_SAMPLE_RATE requests with appstats, the
+# api handlers keep their own lightweight per-route statistics.
+appstats_sample_rate = int(os.environ.get('APPSTATS_SAMPLE_RATE', 100))
+
 def webapp_add_wsgi_middleware(app):
   from google.appengine.ext.appstats import recording
-  app = recording.appstats_wsgi_middleware(app)
-  return app
+  recorded_app = recording.appstats_wsgi_middleware(app)
+  def sampled_app(environ, start_response):
+    if random.randint(1, max(appstats_sample_rate, 1)) == 1:
+      return recorded_app(environ, start_response)
+    return app(environ, start_response)
+  return sampled_app
@@ -0,0 +1,84 @@
+'Deterministic stand-in for the ComicVine client used by benchmarks'
+from datetime import date, timedelta
+import time
+
+# pylint: disable=W0232,E1101,R0903,C0103
+
+ISSUES_PER_VOLUME = 12
+PUBLISHERS = 5
+
+class FakeComicvine(object):
+    '''Generate ComicVine shaped records without any network access.
+
+    latency adds a fixed delay to every call to approximate the
+    upstream round trip.
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def volume(self, volume_id):
+        publisher_id = volume_id % PUBLISHERS + 1
+        return {
+            'id': volume_id,
+            'name': 'Volume %d' % volume_id,
+            'start_year': str(2000 + volume_id % 20),
+            'count_of_issues': ISSUES_PER_VOLUME,
+            'publisher': {
+                'id': publisher_id,
+                'name': 'Publisher %d' % publisher_id,
+            },
+            'image': {'small_url': 'http://example.com/v%d.jpg' % volume_id},
+            'site_detail_url': 'http://example.com/volume/%d' % volume_id,
+            'description': 'Synthetic volume %d' % volume_id,
+            'date_last_updated': '2014-01-01 00:00:00',
+        }
+
+    def issue(self, issue_id):
+        volume_id = issue_id // ISSUES_PER_VOLUME
+        number = issue_id % ISSUES_PER_VOLUME + 1
+        pubdate = date(2014, 1, 1) + timedelta(days=issue_id % 365)
+        return {
+            'id': issue_id,
+            'name': 'Issue %d' % issue_id,
+            'issue_number': str(number),
+            'volume': {
+                'id': volume_id,
+                'name': 'Volume %d' % volume_id,
+            },
+            'cover_date': pubdate.isoformat(),
+            'store_date': pubdate.isoformat(),
+            'image': {'small_url': 'http://example.com/i%d.jpg' % issue_id},
+            'site_detail_url': 'http://example.com/issue/%d' % issue_id,
+            'description': 'Synthetic issue %d' % issue_id,
+            'date_last_updated': '2014-01-01 00:00:00',
+        }
+
+    def fetch_volume_batch(self, volume_ids):
+        self._call()
+        return [self.volume(int(volume_id)) for volume_id in volume_ids]
+
+    def fetch_issue(self, identifier):
+        self._call()
+        return self.issue(int(identifier))
+
+    def fetch_issue_batch(self, issue_ids):
+        self._call()
+        return [self.issue(int(issue_id)) for issue_id in issue_ids]
+
+    def search_volume(self, query, page=0, limit=20):
+        self._call()
+        offset = page * limit
+        results = [self.volume(volume_id)
+                   for volume_id in range(offset + 1, offset + limit + 1)]
+        return 1000, results
+
+_client = FakeComicvine()
+
+def load():
+    return _client
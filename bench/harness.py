@@ -0,0 +1,301 @@
+'''Offline benchmark harness for the api handlers
+
+Runs the api apps in-process against the App Engine testbed stubs and
+a fake ComicVine client, seeds synthetic users and replays a weighted
+request mix.  For example:
+
+    python -m bench.harness --sdk ~/google_appengine --mix reader \\
+        --users 3 --subscriptions 40 --pulls 400 --streams 5
+
+Reports latency percentiles, datastore RPC counts per request and the
+largest growth in resident memory seen while serving each endpoint.
+'''
+import argparse
+from collections import defaultdict
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+APPROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=W0232,E1101,R0903,C0103,F0401
+
+def setup_paths(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.append(os.path.join(APPROOT, 'common'))
+    sys.path.append(os.path.join(APPROOT, 'lib'))
+    sys.path.insert(0, APPROOT)
+
+def setup_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_search_stub()
+    bed.init_taskqueue_stub(root_path=APPROOT)
+    bed.init_user_stub()
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def current_rss_kb():
+    '''Resident set size now, unlike ru_maxrss which only ever grows.'''
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+class Client(object):
+    '''Issue requests to the api apps as one of the synthetic users.'''
+    def __init__(self, cold=False):
+        from api import batch
+        self.find_app = batch.find_app
+        self.cold = cold
+        self.user_index = None
+
+    def login(self, user_index):
+        self.user_index = user_index
+        email = 'bench%d@example.com' % user_index
+        user_id = str(100000 + user_index)
+        os.environ.update({
+            'USER_EMAIL': email,
+            'USER_ID': user_id,
+            'OAUTH_EMAIL': email,
+            'OAUTH_USER_ID': user_id,
+            'OAUTH_AUTH_DOMAIN': 'example.com',
+            'OAUTH_CLIENT_ID': 'bench',
+        })
+
+    def reset_caches(self):
+        from google.appengine.ext import ndb
+        from api import cvcache
+        from api import loader
+        # Each real request starts with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        if self.cold:
+            cvcache.local_cache.clear()
+            loader.catalog.clear()
+
+    def request(self, method, path, body=None):
+        import webapp2
+        request = webapp2.Request.blank(path, environ={
+            'REQUEST_METHOD': method,
+        })
+        request.headers['Authorization'] = 'Bearer bench'
+        if body is not None:
+            request.body = json.dumps(body)
+        self.reset_caches()
+        rss_before = current_rss_kb()
+        started = time.time()
+        response = request.get_response(self.find_app(path.split('?')[0]))
+        elapsed = (time.time() - started) * 1000
+        return response, elapsed, current_rss_kb() - rss_before
+
+    def seed_request(self, method, path, body=None):
+        '''Make a request while seeding, failing on any error status.'''
+        response, _, _ = self.request(method, path, body)
+        if not 200 <= response.status_int < 300:
+            raise RuntimeError('Seeding failed: %s %s returned %s\n%s' % (
+                method, path, response.status, response.body[:2000]))
+        return response
+
+class UserState(object):
+    def __init__(self, index, volume_ids, issue_ids, stream_names):
+        self.index = index
+        self.volume_ids = volume_ids
+        self.issue_ids = issue_ids
+        self.stream_names = stream_names
+
+def seed(client, users, subscriptions, pulls, streams):
+    from api import cvcache
+    from bench import fake_comicvine
+    from pulldb.models import issues
+    cv = fake_comicvine.load()
+    per_volume = fake_comicvine.ISSUES_PER_VOLUME
+    created_issues = set()
+    states = []
+    for user_index in range(users):
+        client.login(user_index)
+        offset = user_index * subscriptions // 2
+        volume_ids = range(offset + 1, offset + subscriptions + 1)
+        issue_ids = [
+            volume_id * per_volume + number
+            for volume_id in volume_ids
+            for number in range(per_volume)
+        ][:pulls]
+        # creates the user record
+        client.seed_request('GET', '/api/pulls/stats')
+        client.seed_request(
+            'POST', '/api/volumes/add', {'volumes': volume_ids})
+        for issue_id in issue_ids:
+            if issue_id not in created_issues:
+                issues.issue_key(cv.fetch_issue(issue_id))
+                created_issues.add(issue_id)
+        client.seed_request(
+            'POST', '/api/subscriptions/add', {'volumes': volume_ids})
+        for index in range(0, len(issue_ids), 200):
+            client.seed_request('POST', '/api/pulls/add', {
+                'issues': issue_ids[index:index + 200]})
+        client.seed_request('POST', '/api/pulls/update', {
+            'pull': issue_ids[:len(issue_ids) * 2 // 3],
+            'read': issue_ids[:len(issue_ids) // 3],
+        })
+        stream_names = ['stream%d' % number for number in range(streams)]
+        client.seed_request(
+            'POST', '/api/streams/add', {'streams': stream_names})
+        client.seed_request('POST', '/api/streams/update', [{
+            'name': name,
+            'volumes': {'add': volume_ids[number::max(streams, 1)]},
+        } for number, name in enumerate(stream_names)])
+        states.append(
+            UserState(user_index, volume_ids, issue_ids, stream_names))
+    cvcache.local_cache.clear()
+    return states
+
+def mark_read(state):
+    return {'read': random.sample(
+        state.issue_ids, min(20, len(state.issue_ids)))}
+
+def mark_unread(state):
+    return {'unread': random.sample(
+        state.issue_ids, min(20, len(state.issue_ids)))}
+
+# (weight, method, path, body) where path is formatted with the user
+# state and body may be a callable taking the user state.
+MIXES = {
+    'reader': [
+        (5, 'GET', '/api/pulls/stats', None),
+        (10, 'GET', '/api/pulls/list/unread?context=1&limit=50', None),
+        (3, 'GET', '/api/pulls/list/new?context=1', None),
+        (2, 'POST', '/api/pulls/update', mark_read),
+        (1, 'POST', '/api/pulls/update', mark_unread),
+        (2, 'GET', '/api/subscriptions/list?context=1', None),
+        (2, 'GET', '/api/streams/list?context=1', None),
+        (1, 'GET', '/api/volumes/{volume_id}/list', None),
+    ],
+    'sync': [
+        (5, 'GET', '/api/pulls/list/all?context=1&limit=100', None),
+        (2, 'GET', '/api/pulls/list/all?count=none&limit=100', None),
+        (3, 'GET', '/api/pulls/stats', None),
+        (1, 'GET', '/api/issues/list?context=1&count=approx', None),
+    ],
+    'search': [
+        (3, 'GET', '/api/volumes/search/comicvine?q=volume', None),
+        (3, 'GET', '/api/volumes/search/comicvine?volume_ids={volume_id}',
+         None),
+        (1, 'GET', '/api/issues/refresh/{issue_id}', None),
+    ],
+}
+
+def replay(client, states, mix, requests):
+    entries = MIXES[mix]
+    weighted = []
+    for entry in entries:
+        weighted.extend([entry] * entry[0])
+    timings = defaultdict(list)
+    memory = defaultdict(int)
+    failures = defaultdict(int)
+    for _ in range(requests):
+        _, method, path, body = random.choice(weighted)
+        state = random.choice(states)
+        client.login(state.index)
+        label = '%s %s' % (method, path)
+        if callable(body):
+            body = body(state)
+        response, elapsed, growth = client.request(
+            method,
+            path.format(
+                volume_id=random.choice(state.volume_ids),
+                issue_id=random.choice(state.issue_ids),
+            ),
+            body,
+        )
+        timings[label].append(elapsed)
+        memory[label] = max(memory[label], growth)
+        if response.status_int >= 400:
+            failures[label] += 1
+    return timings, memory, failures
+
+def report(timings, memory, failures, route_stats):
+    results = {'endpoints': {}, 'routes': {}, 'peak_rss_kb': peak_rss_kb()}
+    for label, values in sorted(timings.items()):
+        results['endpoints'][label] = {
+            'requests': len(values),
+            'failures': failures.get(label, 0),
+            'p50_ms': round(percentile(values, 0.5), 2),
+            'p90_ms': round(percentile(values, 0.9), 2),
+            'p99_ms': round(percentile(values, 0.99), 2),
+            'max_rss_growth_kb': memory.get(label, 0),
+        }
+    for route, counters in sorted(route_stats.items()):
+        requests = counters.get('requests') or 1
+        results['routes'][route] = {
+            name: round(float(value) / requests, 2)
+            for name, value in counters.items()
+            if name.startswith('rpc.') or name == 'comicvine'
+        }
+        results['routes'][route]['requests'] = counters.get('requests', 0)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine python SDK')
+    parser.add_argument('--mix', default='reader', choices=sorted(MIXES))
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--subscriptions', type=int, default=40)
+    parser.add_argument('--pulls', type=int, default=400)
+    parser.add_argument('--streams', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--cv-latency', type=float, default=0.0,
+                        help='simulated ComicVine latency in seconds')
+    parser.add_argument('--cold', action='store_true',
+                        help='clear instance caches before each request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+    random.seed(args.seed)
+    setup_paths(args.sdk)
+    bed = setup_testbed()
+    try:
+        from api import cvcache
+        from api import instrument
+        from bench import fake_comicvine
+        fake_comicvine.load().latency = args.cv_latency
+        cvcache.comicvine = fake_comicvine
+        # Keep counters in process for the report
+        instrument.FLUSH_INTERVAL = float('inf')
+        client = Client(cold=args.cold)
+        states = seed(client, args.users, args.subscriptions, args.pulls,
+                      args.streams)
+        instrument.drain()
+        timings, memory, failures = replay(
+            client, states, args.mix, args.requests)
+        results = report(timings, memory, failures, instrument.drain())
+        results['comicvine_calls'] = fake_comicvine.load().calls
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    finally:
+        bed.deactivate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''Tests for the pull write path
+
+Runs against the App Engine testbed stubs, so the SDK must be available:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest tests.test_pulls
+'''
+import os
+import sys
+import unittest
+
+SDK = os.environ.get('APPENGINE_SDK')
+APPROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=W0232,E1101,R0903,C0103,F0401
+
+@unittest.skipUnless(SDK, 'APPENGINE_SDK is not set')
+class WritePullsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, SDK)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+        sys.path.append(os.path.join(APPROOT, 'common'))
+        sys.path.insert(0, APPROOT)
+
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        from api import counters
+        from api import unread
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.bed.init_datastore_v3_stub(consistency_policy=policy)
+        self.bed.init_memcache_stub()
+        ndb.get_context().set_cache_policy(False)
+        self.user_key = ndb.Key('User', 'writer')
+        counters.reconcile(self.user_key)
+        unread.rebuild(self.user_key)
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def make_pull(self, identifier, **values):
+        from google.appengine.ext import ndb
+        from pulldb.models import pulls
+        values.setdefault('pulled', True)
+        values.setdefault('read', False)
+        return pulls.Pull(
+            key=ndb.Key(pulls.Pull, identifier, parent=self.user_key),
+            **values)
+
+    def test_add_update_and_remove(self):
+        from api import changes
+        from api import counters
+        from api import unread
+        from api.pulls import write_pulls
+        first, second = self.make_pull(1), self.make_pull(2)
+        # listing a pull twice must only count it once
+        write_pulls(self.user_key, updated=[
+            ({}, first), ({}, second), ({}, first)])
+        self.assertEqual(first.key.get(), first)
+        self.assertTrue(changes.change_key(first.key).get())
+        counts = counters.counter_key(self.user_key).get().counts()
+        self.assertEqual(counts['total'], 2)
+        self.assertEqual(counts['unread'], 2)
+        queue = unread.queue_key(self.user_key).get()
+        self.assertEqual(
+            sorted(item[2] for item in queue.entries), [1, 2])
+
+        before = counters.pull_state(first)
+        first.read = True
+        write_pulls(self.user_key, updated=[(before, first)])
+        counts = counters.counter_key(self.user_key).get().counts()
+        self.assertEqual((counts['unread'], counts['read']), (1, 1))
+        queue = unread.queue_key(self.user_key).get()
+        self.assertEqual([item[2] for item in queue.entries], [2])
+
+        write_pulls(self.user_key, deleted=[second])
+        self.assertIsNone(second.key.get())
+        self.assertTrue(changes.change_key(second.key).get().deleted)
+        counts = counters.counter_key(self.user_key).get().counts()
+        self.assertEqual((counts['total'], counts['unread']), (1, 0))
+        self.assertEqual(unread.queue_key(self.user_key).get().entries, [])
+
+if __name__ == '__main__':
+    unittest.main()